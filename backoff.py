@@ -0,0 +1,9 @@
+import random
+
+
+def full_jitter(attempt, base, cap):
+    """
+    Пауза перед повтором номер attempt (full jitter): случайная величина
+    от 0 до экспоненциального предела base * 2 ** attempt, не больше cap
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram пропускает около 30 сообщений в секунду на бота и 1 в секунду в один чат;
+# глобальный лимит берем с запасом под обычную работу бота
+GLOBAL_RATE = 25
+PER_CHAT_INTERVAL = 1
+DEFAULT_CONCURRENCY = 20
+# Сколько раз повторять отправку одному получателю после RetryAfter
+MAX_RETRY_AFTER = 3
+PROGRESS_INTERVAL = 5
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity в запасе.
+    Ожидающие обслуживаются по очереди
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """
+        Обнуляет запас и не выдает токены seconds секунд (ответ RetryAfter)
+        """
+        self._tokens = 0
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._updated:
+                    await asyncio.sleep(self._updated - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    Общий лимит отправки бота плюс минимальный интервал между сообщениями в один чат
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        # chat_id -> время последней отправки, по возрастанию времени
+        self._last_sent = OrderedDict()
+
+    def pause(self, seconds):
+        self.bucket.pause(seconds)
+
+    async def acquire(self, chat_id):
+        last = self._last_sent.get(chat_id)
+        if last is not None:
+            delay = last + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await self.bucket.acquire()
+
+        now = time.monotonic()
+        self._last_sent[chat_id] = now
+        self._last_sent.move_to_end(chat_id)
+        # Чаты, в которые давно не писали, больше не ограничены
+        while self._last_sent:
+            oldest_chat, sent_at = next(iter(self._last_sent.items()))
+            if sent_at + self.per_chat_interval > now:
+                break
+            del self._last_sent[oldest_chat]
+
+
+def is_unreachable(error):
+    """
+    Ошибка означает, что писать пользователю бесполезно:
+    бот заблокирован, аккаунт удален или чат не найден
+    """
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and 'chat not found' in str(error).lower()
+
+
+# Общий лимитер: параллельные рассылки делят один бюджет бота
+telegram_limiter = RateLimiter()
+
+
+class Broadcast:
+    """
+    Рассылка одного сообщения списку получателей.
+    Отправляет из concurrency параллельных воркеров через общий лимитер,
+    на RetryAfter приостанавливает все отправки и повторяет сообщение.
+    recipients - итерируемый или асинхронно итерируемый набор chat_id.
+    acknowledged - последний получатель, до которого включительно
+    обработаны все предыдущие: с него можно продолжить прерванную рассылку.
+    Для недоступных получателей вызывается await on_unreachable(chat_id)
+    """
+
+    def __init__(self, bot, recipients, text, parse_mode=None,
+                 limiter=None, concurrency=DEFAULT_CONCURRENCY,
+                 sent=0, failed=0, acknowledged=None, on_unreachable=None):
+        self.bot = bot
+        self.recipients = recipients
+        self.text = text
+        self.parse_mode = parse_mode
+        self.limiter = limiter or telegram_limiter
+        self.concurrency = concurrency
+        self.sent = sent
+        self.failed = failed
+        self.acknowledged = acknowledged
+        self.on_unreachable = on_unreachable
+        self._resumed_from = sent + failed
+        # Выданные воркерам получатели по порядку и уже обработанные из них
+        self._in_flight = deque()
+        self._done = set()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def processed(self):
+        return self.sent + self.failed
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        """
+        Обработано получателей в секунду за текущий запуск
+        """
+        elapsed = self.elapsed
+        return (self.processed - self._resumed_from) / elapsed if elapsed else 0
+
+    def _acknowledge(self, chat_id):
+        self._done.add(chat_id)
+        while self._in_flight and self._in_flight[0] in self._done:
+            self.acknowledged = self._in_flight.popleft()
+            self._done.discard(self.acknowledged)
+
+    async def _send(self, chat_id):
+        for _ in range(MAX_RETRY_AFTER + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.send_message(chat_id, self.text, parse_mode=self.parse_mode)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Рассылка: RetryAfter {e.retry_after} с")
+                self.limiter.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован или чат не существует - повтор не поможет
+                logger.info(f"Рассылка: {chat_id} недоступен: {e}")
+                if self.on_unreachable and is_unreachable(e):
+                    await self.on_unreachable(chat_id)
+                break
+            except Exception as e:
+                logger.error(f"Ошибка отправки пользователю {chat_id}: {e}")
+                break
+        self.failed += 1
+
+    async def _worker(self, queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                if chat_id is None:
+                    return
+                await self._send(chat_id)
+                self._acknowledge(chat_id)
+            finally:
+                queue.task_done()
+
+    async def _enqueue(self, queue, chat_id):
+        self._in_flight.append(chat_id)
+        await queue.put(chat_id)
+
+    async def _produce(self, queue):
+        if hasattr(self.recipients, '__aiter__'):
+            async for chat_id in self.recipients:
+                await self._enqueue(queue, chat_id)
+        else:
+            for chat_id in self.recipients:
+                await self._enqueue(queue, chat_id)
+
+    async def _report(self, on_progress, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await on_progress(self)
+            except Exception as e:
+                logger.warning(f"Рассылка: не удалось обновить прогресс: {e}")
+
+    async def run(self, on_progress=None, progress_interval=PROGRESS_INTERVAL):
+        """
+        Выполняет рассылку. Каждые progress_interval секунд вызывает
+        await on_progress(self)
+        """
+        self.started_at = time.monotonic()
+        # Ограниченная очередь: получатели читаются не быстрее, чем уходят сообщения
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report(on_progress, progress_interval)) if on_progress else None
+        try:
+            await self._produce(queue)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            if reporter:
+                reporter.cancel()
+            self.finished_at = time.monotonic()
+        return self
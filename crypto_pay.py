@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+
+import aiohttp
+from aiohttp import web
+
+from backoff import full_jitter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = 'https://pay.crypt.bot/api/'
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_CONCURRENCY = 10
+DEFAULT_RETRIES = 3
+# Максимум счетов в одном ответе getInvoices по умолчанию
+INVOICES_BATCH_SIZE = 100
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+
+DEFAULT_WEBHOOK_PATH = '/crypto-pay/webhook'
+WEBHOOK_SIGNATURE_HEADER = 'crypto-pay-api-signature'
+
+# Ответы, после которых имеет смысл повторить запрос
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Для неидемпотентных запросов: сервер точно не обработал запрос
+NOT_PROCESSED_STATUSES = {429}
+
+
+class CryptoPayError(Exception):
+    """
+    Ошибка, которую вернул Crypto Pay API или сеть после всех повторов
+    """
+
+
+class CryptoPayClient:
+    """
+    Асинхронный клиент Crypto Pay API.
+    Использует одну keep-alive сессию с пулом соединений, ограничивает
+    число одновременных запросов и повторяет временные ошибки
+    с экспоненциальной задержкой и случайным джиттером.
+    """
+
+    def __init__(self, token, api_url=DEFAULT_API_URL, timeout=DEFAULT_TIMEOUT,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, retries=DEFAULT_RETRIES):
+        self.token = token
+        self.api_url = api_url if api_url.endswith('/') else api_url + '/'
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self._session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={'Crypto-Pay-API-Token': self.token}
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _request(self, http_method, api_method, idempotent=True, **kwargs):
+        """
+        Выполняет запрос к API с повторами.
+        Неидемпотентный запрос (idempotent=False) повторяется только если сервер его
+        точно не получил или отклонил: ошибка подключения или HTTP 429.
+        После таймаута или 5xx запрос мог быть выполнен, повтор создал бы дубль
+        """
+        url = f"{self.api_url}{api_method}"
+        retryable_statuses = RETRYABLE_STATUSES if idempotent else NOT_PROCESSED_STATUSES
+        retryable_errors = (aiohttp.ClientError, asyncio.TimeoutError) if idempotent else aiohttp.ClientConnectorError
+        last_error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(full_jitter(attempt, BACKOFF_BASE, BACKOFF_MAX))
+
+            try:
+                async with self._semaphore:
+                    session = self._get_session()
+                    async with session.request(http_method, url, **kwargs) as response:
+                        if response.status in retryable_statuses:
+                            last_error = CryptoPayError(f"HTTP {response.status}")
+                            logger.warning(f"Crypto Pay {api_method}: HTTP {response.status}, попытка {attempt + 1}")
+                            continue
+                        if response.status in RETRYABLE_STATUSES:
+                            raise CryptoPayError(f"{api_method}: HTTP {response.status}, повтор небезопасен")
+                        result = await response.json(content_type=None)
+            except retryable_errors as e:
+                last_error = e
+                logger.warning(f"Crypto Pay {api_method}: {e!r}, попытка {attempt + 1}")
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise CryptoPayError(f"{api_method}: {e!r}, повтор небезопасен") from e
+
+            if not result.get('ok'):
+                raise CryptoPayError(result.get('error'))
+            return result['result']
+
+        raise CryptoPayError(f"{api_method} не выполнен после {self.retries + 1} попыток: {last_error!r}")
+
+    async def create_invoice(self, **params):
+        """
+        Создает счет (createInvoice).
+        Не повторяется после таймаута и 5xx, чтобы не создать лишний счет
+        """
+        return await self._request('POST', 'createInvoice', idempotent=False, json=params)
+
+    async def delete_invoice(self, invoice_id):
+        """
+        Удаляет неоплаченный счет (deleteInvoice)
+        """
+        return await self._request('POST', 'deleteInvoice', idempotent=False, json={'invoice_id': invoice_id})
+
+    async def get_invoices(self, invoice_ids=None, **params):
+        """
+        Возвращает список счетов (getInvoices)
+        """
+        if invoice_ids is not None:
+            params['invoice_ids'] = ','.join(str(i) for i in invoice_ids)
+        result = await self._request('GET', 'getInvoices', params=params)
+        return result.get('items', [])
+
+    async def get_invoices_batched(self, invoice_ids, batch_size=INVOICES_BATCH_SIZE):
+        """
+        Загружает счета пачками по batch_size через invoice_ids.
+        Пачки запрашиваются параллельно в пределах лимита одновременных запросов.
+        Возвращает {invoice_id: счет}
+        """
+        invoice_ids = list(invoice_ids)
+        batches = [invoice_ids[i:i + batch_size] for i in range(0, len(invoice_ids), batch_size)]
+        results = await asyncio.gather(
+            *(self.get_invoices(invoice_ids=batch, count=len(batch)) for batch in batches)
+        )
+        return {invoice['invoice_id']: invoice for items in results for invoice in items}
+
+
+# ============= WEBHOOK =============
+
+def check_webhook_signature(token, body, signature):
+    """
+    Проверяет подпись обновления: HMAC-SHA256 от тела запроса,
+    ключ - SHA256 от токена API
+    """
+    if not signature:
+        return False
+    secret = hashlib.sha256(token.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    # Сравниваем байты: строка с не-ASCII символами в compare_digest бросает TypeError
+    return hmac.compare_digest(expected.encode(), signature.encode())
+
+
+def create_webhook_app(token, on_invoice_paid, path=DEFAULT_WEBHOOK_PATH):
+    """
+    Создает aiohttp-приложение, принимающее обновления Crypto Pay.
+    Для каждого invoice_paid вызывается await on_invoice_paid(invoice)
+    """
+    async def handle_update(request):
+        body = await request.read()
+        if not check_webhook_signature(token, body, request.headers.get(WEBHOOK_SIGNATURE_HEADER)):
+            logger.warning("Crypto Pay webhook: неверная подпись")
+            return web.Response(status=401)
+
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+
+        if update.get('update_type') == 'invoice_paid':
+            # При ошибке отвечаем 500, чтобы Crypto Pay повторил доставку
+            await on_invoice_paid(update['payload'])
+        return web.Response(text='OK')
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def start_webhook_server(app, host, port):
+    """
+    Запускает приложение webhook и возвращает runner для остановки
+    """
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Crypto Pay webhook слушает {host}:{port}")
+    return runner
@@ -0,0 +1,512 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'dev_monkey.db'
+DB_POOL_SIZE = 4
+DB_BUSY_TIMEOUT = 30
+DB_CACHE_SIZE_KB = 16384
+# Формат дат в таблицах
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def content_hash(data):
+    """
+    Хэш данных позиции товара для поиска дублей: пробелы нормализуются,
+    чтобы одна и та же строка с другими отступами считалась дублем
+    """
+    return hashlib.sha256(' '.join(data.split()).encode()).hexdigest()
+
+
+class Database:
+    """
+    Пул долгоживущих соединений SQLite с асинхронным API.
+    Все запросы выполняются в пуле потоков, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, path=DB_PATH, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = None
+        self._connections = []
+
+    def _connect(self):
+        # isolation_level=None - транзакции открываются явно в transaction()
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        # WAL позволяет читать параллельно с записью
+        conn.execute("PRAGMA journal_mode = WAL")
+        # В режиме WAL NORMAL не теряет целостность, но не делает fsync на каждый коммит
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def open(self):
+        """
+        Открывает соединения пула
+        """
+        if self._pool is not None:
+            return
+        self._pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            conn = self._connect()
+            self._connections.append(conn)
+            self._pool.put_nowait(conn)
+        logger.info(f"Открыт пул соединений с БД ({self.pool_size} шт)")
+
+    async def close(self):
+        """
+        Закрывает все соединения пула
+        """
+        if self._pool is None:
+            return
+        for _ in range(len(self._connections)):
+            conn = await self._pool.get()
+            conn.close()
+        self._connections = []
+        self._pool = None
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Берет соединение из пула на время блока
+        """
+        if self._pool is None:
+            self.open()
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+
+    async def run(self, func, *args):
+        """
+        Выполняет func(conn, *args) в отдельном потоке без транзакции.
+        Поток нельзя прервать, поэтому при отмене вызывающей задачи
+        соединение возвращается в пул только после его завершения
+        """
+        async with self.connection() as conn:
+            future = asyncio.ensure_future(asyncio.to_thread(func, conn, *args))
+            try:
+                return await asyncio.shield(future)
+            finally:
+                while not future.done():
+                    try:
+                        await asyncio.wait([future])
+                    except asyncio.CancelledError:
+                        pass
+
+    async def transaction(self, func, *args):
+        """
+        Выполняет func(conn, *args) в отдельном потоке внутри транзакции.
+        Транзакция берет блокировку на запись сразу (BEGIN IMMEDIATE),
+        поэтому не упирается в SQLITE_BUSY при повышении блокировки.
+        """
+        return await self.run(_run_in_transaction, func, *args)
+
+    async def migrate(self):
+        """
+        Применяет недостающие миграции схемы.
+        Возвращает количество примененных миграций
+        """
+        return await self.run(_migrate)
+
+    async def fetchone(self, query, params=()):
+        return await self.run(_fetchone, query, params)
+
+    async def fetchall(self, query, params=()):
+        return await self.run(_fetchall, query, params)
+
+    async def execute(self, query, params=()):
+        """
+        Выполняет один изменяющий запрос и возвращает lastrowid
+        """
+        return await self.run(_execute, query, params)
+
+    async def executemany(self, query, seq_of_params):
+        return await self.transaction(_executemany, query, seq_of_params)
+
+
+def _run_in_transaction(conn, func, *args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = func(conn, *args)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return result
+
+
+def _fetchone(conn, query, params):
+    return conn.execute(query, params).fetchone()
+
+
+def _fetchall(conn, query, params):
+    return conn.execute(query, params).fetchall()
+
+
+def _execute(conn, query, params):
+    return conn.execute(query, params).lastrowid
+
+
+def _executemany(conn, query, seq_of_params):
+    return conn.executemany(query, seq_of_params).rowcount
+
+
+# ============= МИГРАЦИИ =============
+
+def _migration_initial_schema(c):
+    # Таблица пользователей с реферальными данными
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (user_id INTEGER PRIMARY KEY,
+                  username TEXT,
+                  first_name TEXT,
+                  joined_date TEXT,
+                  balance REAL DEFAULT 0,
+                  is_admin INTEGER DEFAULT 0,
+                  referral_code TEXT UNIQUE,
+                  referred_by INTEGER,
+                  referral_earnings REAL DEFAULT 0,
+                  FOREIGN KEY (referred_by) REFERENCES users (user_id))''')
+    
+    # Таблица реферальных транзакций
+    c.execute('''CREATE TABLE IF NOT EXISTS referral_transactions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  referrer_id INTEGER,
+                  referred_id INTEGER,
+                  purchase_amount REAL,
+                  commission REAL,
+                  date TEXT,
+                  status TEXT,
+                  FOREIGN KEY (referrer_id) REFERENCES users (user_id),
+                  FOREIGN KEY (referred_id) REFERENCES users (user_id))''')
+    
+    # Таблица товаров
+    c.execute('''CREATE TABLE IF NOT EXISTS products
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT,
+                  type TEXT,
+                  price_rub REAL,
+                  price_usdt REAL,
+                  limit_users INTEGER,
+                  current_users INTEGER DEFAULT 0,
+                  instruction TEXT,
+                  instruction_url TEXT,
+                  data TEXT,
+                  is_active INTEGER DEFAULT 1)''')
+    
+    # Таблица прокси-данных
+    c.execute('''CREATE TABLE IF NOT EXISTS proxy_items
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  product_id INTEGER,
+                  proxy_data TEXT,
+                  is_available INTEGER DEFAULT 1,
+                  used_by INTEGER,
+                  used_date TEXT,
+                  FOREIGN KEY (product_id) REFERENCES products (id))''')
+    
+    # Таблица VPN данных
+    c.execute('''CREATE TABLE IF NOT EXISTS vpn_items
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  product_id INTEGER,
+                  vpn_data TEXT,
+                  is_available INTEGER DEFAULT 1,
+                  used_by INTEGER,
+                  used_date TEXT,
+                  FOREIGN KEY (product_id) REFERENCES products (id))''')
+    
+    # Таблица покупок
+    c.execute('''CREATE TABLE IF NOT EXISTS purchases
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  product_id INTEGER,
+                  proxy_item_id INTEGER,
+                  invoice_id TEXT,
+                  purchase_date TEXT,
+                  expiry_date TEXT,
+                  status TEXT,
+                  data TEXT,
+                  price_rub REAL,
+                  FOREIGN KEY (user_id) REFERENCES users (user_id),
+                  FOREIGN KEY (product_id) REFERENCES products (id),
+                  FOREIGN KEY (proxy_item_id) REFERENCES proxy_items (id))''')
+    
+    # Таблица бесплатных ключей
+    c.execute('''CREATE TABLE IF NOT EXISTS free_keys
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  type TEXT,
+                  key TEXT,
+                  instruction TEXT,
+                  is_available INTEGER DEFAULT 1,
+                  used_by INTEGER,
+                  used_date TEXT)''')
+
+
+def _migration_hot_path_indexes(c):
+    # Выдача товара и подсчет наличия
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_proxy_items_product_available
+                 ON proxy_items (product_id, is_available)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_vpn_items_product_available
+                 ON vpn_items (product_id, is_available)''')
+    
+    # История покупок в профиле
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_purchases_user_date
+                 ON purchases (user_id, purchase_date)''')
+    
+    # Реферальная статистика
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_referral_transactions_referrer_date
+                 ON referral_transactions (referrer_id, date)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_users_referred_by
+                 ON users (referred_by)''')
+    
+    # Бесплатные ключи
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_free_keys_type_available
+                 ON free_keys (type, is_available)''')
+
+
+def _migration_product_stock(c):
+    # Счетчики свободных позиций по товарам, обновляются вместе с позициями
+    c.execute('''CREATE TABLE IF NOT EXISTS product_stock
+                 (product_id INTEGER PRIMARY KEY,
+                  available INTEGER NOT NULL DEFAULT 0,
+                  FOREIGN KEY (product_id) REFERENCES products (id))''')
+    
+    c.execute('''INSERT OR REPLACE INTO product_stock (product_id, available)
+                 SELECT product_id, COUNT(*) FROM (
+                     SELECT product_id FROM proxy_items WHERE is_available = 1
+                     UNION ALL
+                     SELECT product_id FROM vpn_items WHERE is_available = 1
+                 ) GROUP BY product_id''')
+
+
+def _migration_payments(c):
+    # Платежи по счетам Crypto Pay, переживают перезапуск бота
+    c.execute('''CREATE TABLE IF NOT EXISTS payments
+                 (invoice_id INTEGER PRIMARY KEY,
+                  user_id INTEGER,
+                  product_id INTEGER,
+                  amount_rub REAL,
+                  status TEXT,
+                  pay_url TEXT,
+                  created_at TEXT,
+                  expires_at TEXT,
+                  updated_at TEXT,
+                  FOREIGN KEY (user_id) REFERENCES users (user_id),
+                  FOREIGN KEY (product_id) REFERENCES products (id))''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_payments_status_expires
+                 ON payments (status, expires_at)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_payments_user_created
+                 ON payments (user_id, created_at)''')
+
+
+def _migration_newsletter_jobs(c):
+    # Рассылки с курсором по users.user_id, продолжаются после перезапуска
+    c.execute('''CREATE TABLE IF NOT EXISTS newsletter_jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  admin_chat_id INTEGER,
+                  status_message_id INTEGER,
+                  text TEXT,
+                  status TEXT,
+                  last_user_id INTEGER DEFAULT 0,
+                  total INTEGER DEFAULT 0,
+                  sent INTEGER DEFAULT 0,
+                  failed INTEGER DEFAULT 0,
+                  created_at TEXT,
+                  updated_at TEXT)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_newsletter_jobs_status
+                 ON newsletter_jobs (status)''')
+
+
+def _migration_user_deliverability(c):
+    # Пользователи, которым бот не может писать (заблокировали бота, удалены)
+    c.execute("ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0")
+    c.execute("ALTER TABLE users ADD COLUMN delivery_failed_at TEXT")
+
+
+def _migration_daily_stats(c):
+    # Дневные итоги для статистики админа: строки с product_id = 0 - по пользователям
+    # и рефералам, остальные - продажи по товарам. day = 'total' - итог за все время
+    c.execute('''CREATE TABLE IF NOT EXISTS daily_stats
+                 (day TEXT NOT NULL,
+                  product_id INTEGER NOT NULL DEFAULT 0,
+                  new_users INTEGER NOT NULL DEFAULT 0,
+                  referred_users INTEGER NOT NULL DEFAULT 0,
+                  purchases INTEGER NOT NULL DEFAULT 0,
+                  revenue REAL NOT NULL DEFAULT 0,
+                  referrals INTEGER NOT NULL DEFAULT 0,
+                  commissions REAL NOT NULL DEFAULT 0,
+                  PRIMARY KEY (day, product_id))''')
+    
+    # Заполнение по существующей истории
+    for day in ("substr(joined_date, 1, 10)", "'total'"):
+        c.execute(f'''INSERT INTO daily_stats (day, product_id, new_users, referred_users)
+                      SELECT {day}, 0, COUNT(*), COUNT(referred_by) FROM users
+                      WHERE joined_date IS NOT NULL OR {day} = 'total'
+                      GROUP BY 1''')
+    for day in ("substr(date, 1, 10)", "'total'"):
+        c.execute(f'''INSERT INTO daily_stats (day, product_id, referrals, commissions)
+                      SELECT {day}, 0, COUNT(*), COALESCE(SUM(commission), 0) FROM referral_transactions
+                      WHERE date IS NOT NULL OR {day} = 'total'
+                      GROUP BY 1
+                      ON CONFLICT (day, product_id) DO UPDATE
+                      SET referrals = excluded.referrals, commissions = excluded.commissions''')
+    for day in ("substr(purchase_date, 1, 10)", "'total'"):
+        c.execute(f'''INSERT INTO daily_stats (day, product_id, purchases, revenue)
+                      SELECT {day}, product_id, COUNT(*), COALESCE(SUM(price_rub), 0) FROM purchases
+                      WHERE purchase_date IS NOT NULL OR {day} = 'total'
+                      GROUP BY 1, 2''')
+
+
+def _migration_free_keys_user_index(c):
+    # Полученные бесплатные ключи в профиле
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_free_keys_used_by_date
+                 ON free_keys (used_by, used_date)''')
+
+
+def _migration_outbox(c):
+    # Исходящие сообщения, записываются в транзакции вместе с изменением,
+    # отправляются фоновым диспетчером
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  chat_id INTEGER,
+                  text TEXT,
+                  parse_mode TEXT,
+                  reply_markup TEXT,
+                  status TEXT DEFAULT 'pending',
+                  attempts INTEGER DEFAULT 0,
+                  next_attempt_at REAL,
+                  last_error TEXT,
+                  created_at TEXT,
+                  sent_at TEXT)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_outbox_status_next_attempt
+                 ON outbox (status, next_attempt_at)''')
+
+
+def _migration_referral_counters(c):
+    # Счетчики рефералов на строке реферера вместо подсчета при каждом показе профиля
+    c.execute("ALTER TABLE users ADD COLUMN referral_count INTEGER DEFAULT 0")
+    c.execute('''UPDATE users SET referral_count =
+                     (SELECT COUNT(*) FROM users r WHERE r.referred_by = users.user_id)''')
+    # referral_earnings пополняется вместе с комиссией, сверяем с транзакциями
+    c.execute('''UPDATE users SET referral_earnings =
+                     COALESCE((SELECT SUM(commission) FROM referral_transactions
+                               WHERE referrer_id = users.user_id), 0)''')
+
+
+def _migration_item_hashes(c):
+    # Уникальный хэш данных в пределах товара: одна позиция не продается дважды
+    for table, column in (('proxy_items', 'proxy_data'), ('vpn_items', 'vpn_data')):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN content_hash TEXT")
+        
+        # Из дублей хэш получает проданная или самая ранняя позиция,
+        # остальные свободные копии снимаются с продажи
+        seen = set()
+        hashes = []
+        retired = []
+        rows = c.execute(f"SELECT id, product_id, {column}, is_available FROM {table} "
+                         f"ORDER BY is_available, id").fetchall()
+        for item_id, product_id, data, is_available in rows:
+            key = (product_id, content_hash(data or ''))
+            if key in seen:
+                if is_available:
+                    retired.append((item_id,))
+                continue
+            seen.add(key)
+            hashes.append((key[1], item_id))
+        c.executemany(f"UPDATE {table} SET content_hash = ? WHERE id = ?", hashes)
+        c.executemany(f"UPDATE {table} SET is_available = 0 WHERE id = ?", retired)
+        if retired:
+            logger.info(f"{table}: снято с продажи дублей: {len(retired)}")
+        
+        c.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_product_hash
+                      ON {table} (product_id, content_hash)''')
+    
+    # Пересчитываем наличие после снятия дублей
+    c.execute('''UPDATE product_stock SET available = (
+                     SELECT COUNT(*) FROM proxy_items p
+                     WHERE p.product_id = product_stock.product_id AND p.is_available = 1
+                 ) + (
+                     SELECT COUNT(*) FROM vpn_items v
+                     WHERE v.product_id = product_stock.product_id AND v.is_available = 1
+                 )''')
+
+
+def _migration_proxy_health(c):
+    # Результаты проверки прокси; нерабочие снимаются с продажи в карантин
+    c.execute("ALTER TABLE proxy_items ADD COLUMN is_quarantined INTEGER DEFAULT 0")
+    c.execute("ALTER TABLE proxy_items ADD COLUMN latency_ms INTEGER")
+    c.execute("ALTER TABLE proxy_items ADD COLUMN last_checked_at TEXT")
+    c.execute("ALTER TABLE proxy_items ADD COLUMN check_failures INTEGER DEFAULT 0")
+    c.execute("ALTER TABLE proxy_items ADD COLUMN last_error TEXT")
+
+
+def _migration_low_stock_threshold(c):
+    # Порог остатка для уведомления админа; NULL - порог по умолчанию
+    c.execute("ALTER TABLE products ADD COLUMN low_stock_threshold INTEGER")
+
+
+def _migration_stock_reservations(c):
+    # Единицы товара, зарезервированные под открытые счета; в продаже available - reserved.
+    # Счета, созданные до резервирования, резерв не держат
+    c.execute("ALTER TABLE product_stock ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE payments ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0")
+
+
+# Порядок менять нельзя: номер миграции хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migration_initial_schema,
+    _migration_hot_path_indexes,
+    _migration_product_stock,
+    _migration_payments,
+    _migration_newsletter_jobs,
+    _migration_user_deliverability,
+    _migration_daily_stats,
+    _migration_free_keys_user_index,
+    _migration_outbox,
+    _migration_referral_counters,
+    _migration_item_hashes,
+    _migration_proxy_health,
+    _migration_low_stock_threshold,
+    _migration_stock_reservations,
+]
+
+
+def _get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _migrate(conn):
+    if _get_schema_version(conn) >= len(MIGRATIONS):
+        return 0
+
+    applied = 0
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Повторная проверка под блокировкой: миграцию мог применить другой процесс
+            if _get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied += 1
+        logger.info(f"Применена миграция {version}: {migration.__name__}")
+    return applied
+
+
+# Общий экземпляр для всех обработчиков
+db = Database()
@@ -1,10 +1,13 @@
 import os
 import logging
-import sqlite3
 import asyncio
-import requests
+import csv
+import html
+import math
 import random
 import string
+import time
+from functools import lru_cache
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
@@ -15,11 +18,21 @@ from aiogram.types import (
     KeyboardButton, BotCommand, BotCommandScopeDefault
 )
 from aiogram.enums.parse_mode import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
+from broadcast import Broadcast
+from crypto_pay import CryptoPayClient, CryptoPayError, create_webhook_app, start_webhook_server
+from database import DATE_FORMAT, content_hash, db
+from outbox import OutboxDispatcher, enqueue
+import newsletters
+from payments import PaymentStore, release_item, reserve_item, update_payment_status
+from proxy_health import ProxyHealthChecker
+from stock_alerts import StockAlerts
+
 # Загрузка переменных окружения
 load_dotenv()
 
@@ -33,11 +46,39 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 CRYPTO_BOT_TOKEN = os.getenv('CRYPTO_BOT_TOKEN', '452163:AAGTBJKe7YvufexfRN78tFhnTdGywQyUMSX')
-CRYPTO_API_URL = 'https://pay.crypt.bot/api/'
+CRYPTO_API_URL = os.getenv('CRYPTO_API_URL', 'https://pay.crypt.bot/api/')
 ADMIN_ID = 7973988177
 USDT_TO_RUB = 80
 PAYMENT_EXPIRY_MINUTES = 30
+# Частота проверки счета по возрасту: (возраст до, сек; интервал, сек)
+PAYMENT_CHECK_SCHEDULE = ((120, 5), (600, 15), (float('inf'), 60))
+# При включенном webhook опрос остается только как редкая страховка
+PAYMENT_POLL_FALLBACK_INTERVAL = 120
+PAYMENT_CHECKER_MAX_SLEEP = 60
+# Через сколько секунд повторить истечение счета, если статус не удалось получить
+PAYMENT_EXPIRE_RETRY_DELAY = 30
+# Webhook Crypto Pay: порт 0 - выключен
+CRYPTO_WEBHOOK_HOST = os.getenv('CRYPTO_WEBHOOK_HOST', '0.0.0.0')
+CRYPTO_WEBHOOK_PORT = int(os.getenv('CRYPTO_WEBHOOK_PORT', '0'))
+CRYPTO_WEBHOOK_PATH = os.getenv('CRYPTO_WEBHOOK_PATH', '/crypto-pay/webhook')
+# Как часто пересчитывать статистику админа в фоне (секунды)
+STATS_REFRESH_INTERVAL = int(os.getenv('STATS_REFRESH_INTERVAL', '300'))
+# Проверка прокси: как часто перепроверять каждый прокси (секунды), сколько проверок одновременно
+PROXY_CHECK_INTERVAL = int(os.getenv('PROXY_CHECK_INTERVAL', '3600'))
+PROXY_CHECK_CONCURRENCY = int(os.getenv('PROXY_CHECK_CONCURRENCY', '100'))
+PROXY_CHECK_TARGET = os.getenv('PROXY_CHECK_TARGET', 'www.google.com:443')
+# Остаток товара, при котором админ получает уведомление (если у товара не задан свой порог)
+LOW_STOCK_THRESHOLD = int(os.getenv('LOW_STOCK_THRESHOLD', '5'))
 REFERRAL_PERCENT = 20  # 20% от покупки реферала
+# Загрузка товаров файлом: размер пачки, предел длины строки, лимит Bot API на скачивание
+IMPORT_CHUNK_SIZE = 1000
+IMPORT_MAX_LINE_LENGTH = 1024
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+IMPORT_DOWNLOAD_TIMEOUT = 300
+# Сколько покупок и ключей показывать в профиле и на странице истории
+PROFILE_PURCHASES_LIMIT = 5
+PROFILE_FREE_KEYS_LIMIT = 5
+PURCHASE_HISTORY_PAGE_SIZE = 10
 INSTRUCTION_SITE = "https://www.devmonkey.click"
 
 # Цветовая схема (для эмодзи и оформления)
@@ -68,14 +109,68 @@ GREEN_EMOJIS = {
 storage = MemoryStorage()
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=storage)
+crypto_client = CryptoPayClient(CRYPTO_BOT_TOKEN, CRYPTO_API_URL)
 
-# Хранилище для отслеживания платежей
-pending_payments = {}
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Кэш каталога товаров
+class ProductCatalog:
+    """
+    Кэш таблицы products в памяти.
+    Загружается при первом обращении и сбрасывается при изменениях из админки
+    """
+    
+    def __init__(self):
+        self._products = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+    
+    async def _load(self):
+        products = self._products
+        if products is not None:
+            return products
+        
+        async with self._lock:
+            if self._products is None:
+                generation = self._generation
+                rows = await db.fetchall("SELECT * FROM products ORDER BY id")
+                products = {row[0]: row for row in rows}
+                # Если кэш сбросили во время загрузки, данные уже устарели
+                if generation != self._generation:
+                    return products
+                self._products = products
+            return self._products
+    
+    async def get(self, product_id):
+        return (await self._load()).get(product_id)
+    
+    async def all(self):
+        return list((await self._load()).values())
+    
+    async def active(self, type_prefix=''):
+        """
+        Активные товары, тип которых начинается с type_prefix
+        """
+        return [p for p in await self.all() if p[10] == 1 and p[2].startswith(type_prefix)]
+    
+    def invalidate(self):
+        self._generation += 1
+        self._products = None
+
+catalog = ProductCatalog()
 
 # Состояния для FSM
 class AdminStates(StatesGroup):
     waiting_for_newsletter = State()
     waiting_for_price_change = State()
+    waiting_for_stock_threshold = State()
     waiting_for_product_name = State()
     waiting_for_product_price = State()
     waiting_for_product_type = State()
@@ -91,98 +186,13 @@ class AdminStates(StatesGroup):
     waiting_for_price_product_id = State()
 
 # Инициализация базы данных
-def init_db():
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    
-    # Таблица пользователей с реферальными данными
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (user_id INTEGER PRIMARY KEY,
-                  username TEXT,
-                  first_name TEXT,
-                  joined_date TEXT,
-                  balance REAL DEFAULT 0,
-                  is_admin INTEGER DEFAULT 0,
-                  referral_code TEXT UNIQUE,
-                  referred_by INTEGER,
-                  referral_earnings REAL DEFAULT 0,
-                  FOREIGN KEY (referred_by) REFERENCES users (user_id))''')
-    
-    # Таблица реферальных транзакций
-    c.execute('''CREATE TABLE IF NOT EXISTS referral_transactions
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  referrer_id INTEGER,
-                  referred_id INTEGER,
-                  purchase_amount REAL,
-                  commission REAL,
-                  date TEXT,
-                  status TEXT,
-                  FOREIGN KEY (referrer_id) REFERENCES users (user_id),
-                  FOREIGN KEY (referred_id) REFERENCES users (user_id))''')
-    
-    # Таблица товаров
-    c.execute('''CREATE TABLE IF NOT EXISTS products
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT,
-                  type TEXT,
-                  price_rub REAL,
-                  price_usdt REAL,
-                  limit_users INTEGER,
-                  current_users INTEGER DEFAULT 0,
-                  instruction TEXT,
-                  instruction_url TEXT,
-                  data TEXT,
-                  is_active INTEGER DEFAULT 1)''')
-    
-    # Таблица прокси-данных
-    c.execute('''CREATE TABLE IF NOT EXISTS proxy_items
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  product_id INTEGER,
-                  proxy_data TEXT,
-                  is_available INTEGER DEFAULT 1,
-                  used_by INTEGER,
-                  used_date TEXT,
-                  FOREIGN KEY (product_id) REFERENCES products (id))''')
-    
-    # Таблица VPN данных
-    c.execute('''CREATE TABLE IF NOT EXISTS vpn_items
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  product_id INTEGER,
-                  vpn_data TEXT,
-                  is_available INTEGER DEFAULT 1,
-                  used_by INTEGER,
-                  used_date TEXT,
-                  FOREIGN KEY (product_id) REFERENCES products (id))''')
-    
-    # Таблица покупок
-    c.execute('''CREATE TABLE IF NOT EXISTS purchases
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  product_id INTEGER,
-                  proxy_item_id INTEGER,
-                  invoice_id TEXT,
-                  purchase_date TEXT,
-                  expiry_date TEXT,
-                  status TEXT,
-                  data TEXT,
-                  price_rub REAL,
-                  FOREIGN KEY (user_id) REFERENCES users (user_id),
-                  FOREIGN KEY (product_id) REFERENCES products (id),
-                  FOREIGN KEY (proxy_item_id) REFERENCES proxy_items (id))''')
-    
-    # Таблица бесплатных ключей
-    c.execute('''CREATE TABLE IF NOT EXISTS free_keys
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  type TEXT,
-                  key TEXT,
-                  instruction TEXT,
-                  is_available INTEGER DEFAULT 1,
-                  used_by INTEGER,
-                  used_date TEXT)''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("База данных инициализирована")
+async def init_db():
+    db.open()
+    applied = await db.migrate()
+    if applied:
+        logger.info(f"База данных инициализирована (применено миграций: {applied})")
+    else:
+        logger.info("Схема базы данных актуальна")
 
 # Генерация реферального кода
 def generate_referral_code(user_id):
@@ -190,37 +200,58 @@ def generate_referral_code(user_id):
     random_part = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
     return f"DEV{user_id}{random_part}"
 
+# Дневная статистика
+STATS_ALL_TIME = 'total'
+
+def _add_daily_stats(c, product_id=0, **counters):
+    """
+    Прибавляет счетчики к строкам статистики за сегодня и за все время.
+    Вызывается в транзакции изменения, которое считает
+    """
+    columns = ', '.join(counters)
+    placeholders = ', '.join('?' * len(counters))
+    updates = ', '.join(f"{name} = {name} + excluded.{name}" for name in counters)
+    for day in (datetime.now().strftime("%Y-%m-%d"), STATS_ALL_TIME):
+        c.execute(f'''INSERT INTO daily_stats (day, product_id, {columns})
+                      VALUES (?, ?, {placeholders})
+                      ON CONFLICT (day, product_id) DO UPDATE SET {updates}''',
+                  (day, product_id, *counters.values()))
+
+def _register_user(c, user_id, username, first_name, referral_code, referred_by=None, is_admin=0,
+                   referrer_notice=None):
+    """
+    Добавляет пользователя; referrer_notice ставится в очередь рефереру
+    в той же транзакции
+    """
+    c.execute('''INSERT INTO users 
+                 (user_id, username, first_name, is_admin, joined_date, referral_code, referred_by) 
+                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
+              (user_id, username, first_name, is_admin,
+               datetime.now().strftime(DATE_FORMAT),
+               referral_code, referred_by))
+    _add_daily_stats(c, new_users=1, referred_users=1 if referred_by else 0)
+    if referred_by:
+        c.execute("UPDATE users SET referral_count = referral_count + 1 WHERE user_id = ?", (referred_by,))
+    if referrer_notice:
+        enqueue(c, referred_by, referrer_notice, ParseMode.HTML)
+
 # Добавление админа
-def add_admin():
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    
+async def add_admin():
     # Проверяем, есть ли уже админ
-    c.execute("SELECT * FROM users WHERE user_id = ?", (ADMIN_ID,))
-    admin = c.fetchone()
+    admin = await db.fetchone("SELECT * FROM users WHERE user_id = ?", (ADMIN_ID,))
     
     if not admin:
         # Генерируем реферальный код для админа
         referral_code = generate_referral_code(ADMIN_ID)
-        c.execute('''INSERT INTO users 
-                     (user_id, username, is_admin, joined_date, referral_code) 
-                     VALUES (?, ?, ?, ?, ?)''',
-                  (ADMIN_ID, 'admin', 1, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), referral_code))
+        await db.transaction(_register_user, ADMIN_ID, 'admin', None, referral_code, None, 1)
     else:
         # Обновляем статус админа, если нужно
-        c.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (ADMIN_ID,))
-    
-    conn.commit()
-    conn.close()
+        await db.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (ADMIN_ID,))
 
 # Добавление начальных товаров с инструкциями
-def add_initial_products():
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    
+async def add_initial_products():
     # Проверяем, есть ли уже товары
-    c.execute("SELECT COUNT(*) FROM products")
-    count = c.fetchone()[0]
+    count = (await db.fetchone("SELECT COUNT(*) FROM products"))[0]
     
     if count == 0:
         products = [
@@ -237,282 +268,437 @@ def add_initial_products():
              'Скачайте приложение и введите полученные данные', 
              f'{INSTRUCTION_SITE}/#vpn', '', 1)
         ]
-        c.executemany('''INSERT INTO products 
-                        (name, type, price_rub, price_usdt, limit_users, current_users, 
-                         instruction, instruction_url, data, is_active) 
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', products)
-        conn.commit()
+        await db.executemany('''INSERT INTO products 
+                                (name, type, price_rub, price_usdt, limit_users, current_users, 
+                                 instruction, instruction_url, data, is_active) 
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', products)
+        catalog.invalidate()
         logger.info("Начальные товары добавлены")
-    
-    conn.close()
 
 # Функции для работы с Crypto Bot API
-def create_crypto_invoice(amount_usdt, description, payload):
+async def create_crypto_invoice(amount_usdt, description, payload):
     """
     Создание счета в Crypto Bot
     """
+    data = {
+        'asset': 'USDT',
+        'amount': str(amount_usdt),
+        'description': description,
+        'hidden_message': f'{GREEN_EMOJIS["leaf"]} Спасибо за покупку! Товар будет выдан автоматически.',
+        'payload': payload,
+        'expires_in': PAYMENT_EXPIRY_MINUTES * 60
+    }
+    
+    logger.info(f"Создание счета: {data}")
     try:
-        headers = {
-            'Content-Type': 'application/json',
-            'Crypto-Pay-API-Token': CRYPTO_BOT_TOKEN
-        }
-        
-        data = {
-            'asset': 'USDT',
-            'amount': str(amount_usdt),
-            'description': description,
-            'hidden_message': f'{GREEN_EMOJIS["leaf"]} Спасибо за покупку! Товар будет выдан автоматически.',
-            'payload': payload,
-            'expires_in': PAYMENT_EXPIRY_MINUTES * 60
-        }
-        
-        logger.info(f"Создание счета: {data}")
-        response = requests.post(
-            f"{CRYPTO_API_URL}createInvoice", 
-            headers=headers, 
-            json=data, 
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        if result.get('ok'):
-            return result['result']
-        else:
-            logger.error(f"Ошибка Crypto Bot API: {result.get('error')}")
-            return None
-            
+        return await crypto_client.create_invoice(**data)
+    except CryptoPayError as e:
+        logger.error(f"Ошибка Crypto Bot API: {e}")
+        return None
     except Exception as e:
         logger.error(f"Ошибка при создании счета: {e}")
         return None
 
-def check_invoice_status(invoice_id):
+async def delete_crypto_invoice(invoice_id):
+    """
+    Удаление неоплаченного счета в Crypto Bot. Возвращает False, если удалить не удалось
+    """
+    try:
+        await crypto_client.delete_invoice(invoice_id)
+        return True
+    except CryptoPayError as e:
+        logger.error(f"Ошибка удаления счета {invoice_id}: {e}")
+        return False
+
+async def check_invoice_status(invoice_id):
     """
     Проверка статуса счета
     """
     try:
-        headers = {
-            'Content-Type': 'application/json',
-            'Crypto-Pay-API-Token': CRYPTO_BOT_TOKEN
-        }
-        
-        params = {
-            'invoice_ids': invoice_id
-        }
-        
-        response = requests.get(
-            f"{CRYPTO_API_URL}getInvoices",
-            headers=headers,
-            params=params,
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        
-        if result.get('ok') and result.get('result', {}).get('items'):
-            invoice = result['result']['items'][0]
-            return invoice.get('status')
-        else:
-            logger.error(f"Не удалось получить статус счета {invoice_id}")
-            return None
-            
+        items = await crypto_client.get_invoices(invoice_ids=[invoice_id])
     except Exception as e:
         logger.error(f"Ошибка при проверке статуса: {e}")
         return None
+    
+    if items:
+        return items[0].get('status')
+    
+    logger.error(f"Не удалось получить статус счета {invoice_id}")
+    return None
+
+async def check_invoice_statuses(invoice_ids):
+    """
+    Пакетная проверка статусов счетов: {invoice_id: статус}.
+    None - API недоступен и статусы неизвестны
+    """
+    try:
+        invoices = await crypto_client.get_invoices_batched(invoice_ids)
+    except Exception as e:
+        logger.error(f"Ошибка при пакетной проверке статусов: {e}")
+        return None
+    return {invoice_id: invoice.get('status') for invoice_id, invoice in invoices.items()}
+
+# Подтверждение оплаты
+async def confirm_payment(payment_data):
+    """
+    Проводит оплаченный счет и выдает товар.
+    Возвращает False, если счет уже был обработан другим путем
+    """
+    if not payments.mark_finished(payment_data, 'paid'):
+        return False
+    
+    product = await catalog.get(payment_data['product_id'])
+    try:
+        settled = await db.transaction(_settle_purchase, payment_data, product)
+    except Exception:
+        # Счет снова открыт и будет проведен при следующей проверке
+        payments.reopen(payment_data)
+        raise
+    
+    if settled is None:
+        # Счет уже проведен другим процессом
+        return False
+    
+    # Сообщения уже в очереди, их отправит диспетчер
+    outbox_dispatcher.wake()
+    
+    issued, booked = settled
+    if issued:
+        stock_alerts.observe(payment_data['product_id'], issued[2])
+        logger.info(f"Товар выдан пользователю {payment_data['user_id']}")
+    else:
+        logger.error(f"Нет доступных товаров для продукта {payment_data['product_id']}")
+    if booked:
+        logger.info(f"Начислена комиссия {booked[1]}₽ рефереру {booked[0]} от пользователя {payment_data['user_id']}")
+    return True
 
 # Фоновая проверка платежей
 async def payment_checker():
     """
-    Фоновая задача для проверки статусов платежей
+    Фоновая задача для проверки статусов платежей.
+    Обрабатывает только счета с наступившим сроком проверки или истечения
     """
     while True:
         try:
-            for user_id, payment_data in list(pending_payments.items()):
-                if payment_data['status'] == 'pending':
-                    # Проверяем не истекло ли время
-                    if datetime.now() > payment_data['expires_at']:
-                        payment_data['status'] = 'expired'
-                        logger.info(f"Платеж для пользователя {user_id} истек")
-                        continue
-                    
-                    # Проверяем статус в API
-                    status = check_invoice_status(payment_data['invoice_id'])
-                    
+            expired, due = payments.pop_due()
+            
+            # Проверяем статусы в API пачками вместо запроса на каждый счет.
+            # Истекающие счета тоже проверяем: оплата могла прийти в последний момент
+            to_check = expired + due
+            statuses = await check_invoice_statuses([p['invoice_id'] for p in to_check]) if to_check else {}
+            
+            for payment_data in expired:
+                try:
+                    if statuses is None:
+                        # Без статуса нельзя отличить истекший счет от оплаченного в последний момент
+                        payments.postpone_expire(payment_data, PAYMENT_EXPIRE_RETRY_DELAY)
+                    elif statuses.get(payment_data['invoice_id']) == 'paid':
+                        await confirm_payment(payment_data)
+                    # Счет истек в Crypto Pay или удален (его нет в ответе) - оплатить его уже нельзя
+                    elif await payments.finish(payment_data, 'expired'):
+                        logger.info(f"Платеж {payment_data['invoice_id']} пользователя {payment_data['user_id']} истек")
+                except Exception as e:
+                    logger.error(f"Ошибка при истечении платежа {payment_data['invoice_id']}: {e}")
+                    payments.postpone_expire(payment_data, PAYMENT_EXPIRE_RETRY_DELAY)
+            
+            for payment_data in due:
+                status = statuses.get(payment_data['invoice_id']) if statuses is not None else None
+                
+                # finish() вернет False, если платеж уже завершен (например, через check_payment)
+                try:
                     if status == 'paid':
-                        payment_data['status'] = 'paid'
-                        
-                        # Выдаем товар и начисляем реферальные
-                        await deliver_product(user_id, payment_data['product_id'], payment_data['amount_rub'])
-                        
+                        await confirm_payment(payment_data)
                     elif status in ['expired', 'cancelled']:
-                        payment_data['status'] = status
+                        await payments.finish(payment_data, status)
+                except Exception as e:
+                    # Следующая проверка счета уже запланирована в pop_due()
+                    logger.error(f"Ошибка при проверке платежа {payment_data['invoice_id']}: {e}")
             
-            await asyncio.sleep(10)
+            # Завершенные платежи не копятся в памяти
+            payments.evict_finished()
+            
+            await payments.wait_due(PAYMENT_CHECKER_MAX_SLEEP)
             
         except Exception as e:
             logger.error(f"Ошибка в payment_checker: {e}")
             await asyncio.sleep(30)
 
-# Начисление реферальных
-async def add_referral_commission(user_id, purchase_amount):
+# Подтверждение оплаты через webhook
+async def handle_invoice_paid(invoice):
     """
-    Начисляет комиссию рефереру
+    Выдает товар сразу после уведомления invoice_paid от Crypto Pay
     """
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    
-    # Получаем информацию о реферере
-    c.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
+    invoice_id = invoice.get('invoice_id')
+    payment_data = await payments.find(invoice_id)
+    if not payment_data:
+        logger.warning(f"Webhook: счет {invoice_id} не найден")
+        return
     
-    if result and result[0]:
-        referrer_id = result[0]
-        commission = purchase_amount * (REFERRAL_PERCENT / 100)
-        
-        # Обновляем баланс реферера
-        c.execute('''UPDATE users 
-                     SET balance = balance + ?, referral_earnings = referral_earnings + ? 
-                     WHERE user_id = ?''',
-                  (commission, commission, referrer_id))
-        
-        # Записываем транзакцию
-        c.execute('''INSERT INTO referral_transactions 
-                     (referrer_id, referred_id, purchase_amount, commission, date, status)
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (referrer_id, user_id, purchase_amount, commission, 
-                   datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'completed'))
-        
-        logger.info(f"Начислена комиссия {commission}₽ рефереру {referrer_id} от пользователя {user_id}")
-        
-        # Уведомляем реферера
+    # Повторная доставка обновления или платеж уже обработан опросом
+    if await confirm_payment(payment_data):
+        logger.info(f"Webhook: счет {invoice_id} оплачен пользователем {payment_data['user_id']}")
+    elif payment_data['status'] not in ['pending', 'paid']:
+        # Деньги пришли за счет, который у нас уже истек или отменен - товар не выдан
+        logger.error(f"Webhook: счет {invoice_id} оплачен, но платеж в статусе {payment_data['status']}")
         try:
             await bot.send_message(
-                referrer_id,
-                f"{GREEN_EMOJIS['money']} <b>Реферальное вознаграждение!</b>\n\n"
-                f"Ваш друг совершил покупку на {purchase_amount}₽\n"
-                f"Вам начислено: {commission:.2f}₽ ({REFERRAL_PERCENT}%)\n\n"
-                f"Текущий баланс можно посмотреть в профиле.",
-                parse_mode=ParseMode.HTML
+                ADMIN_ID,
+                f"{GREEN_EMOJIS['warning']} Счет {invoice_id} оплачен в Crypto Pay, "
+                f"но платеж пользователя {payment_data['user_id']} уже в статусе {payment_data['status']}. "
+                "Товар не выдан, нужна ручная проверка."
             )
         except Exception as e:
-            logger.error(f"Не удалось уведомить реферера {referrer_id}: {e}")
-    
-    conn.commit()
-    conn.close()
+            logger.error(f"Не удалось уведомить админа об оплате закрытого счета {invoice_id}: {e}")
 
-# Выдача товара после оплаты
-async def deliver_product(user_id, product_id, amount_rub):
+# Доступность пользователей
+async def mark_unreachable(user_id):
     """
-    Выдача товара пользователю после успешной оплаты
+    Отмечает, что бот не может писать пользователю.
+    Отметку снимает следующий /start от пользователя
     """
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
+    await db.execute("UPDATE users SET is_blocked = 1, delivery_failed_at = ? WHERE user_id = ?",
+                     (datetime.now().strftime(DATE_FORMAT), user_id))
+
+# Исходящие сообщения
+async def report_undelivered(chat_id, text, error):
+    """
+    Сообщает админу о сообщении, которое не удалось доставить.
+    Отправляется без разметки: ошибка могла быть как раз в HTML исходного текста
+    """
+    try:
+        await bot.send_message(
+            ADMIN_ID,
+            f"{GREEN_EMOJIS['warning']} Не удалось доставить сообщение пользователю {chat_id}: {error}\n\n{text}"
+        )
+    except Exception as e:
+        logger.error(f"Не удалось уведомить админа о недоставленном сообщении: {e}")
+
+outbox_dispatcher = OutboxDispatcher(bot, on_unreachable=mark_unreachable, on_failed=report_undelivered)
+
+# Уведомления об остатках
+async def low_stock_threshold(product_id):
+    """
+    Порог остатка товара из кэша каталога; None - товар не отслеживается
+    """
+    product = await catalog.get(product_id)
+    if not product or product[10] != 1:
+        return None
+    return product[11] if product[11] is not None else LOW_STOCK_THRESHOLD
+
+async def report_low_stock(product_id, available, threshold):
+    """
+    Сообщает админу, что товар заканчивается или закончился
+    """
+    product = await catalog.get(product_id)
+    if available <= 0:
+        text = f"{GREEN_EMOJIS['warning']} <b>Товар закончился:</b> {product[1]}"
+    else:
+        text = f"{GREEN_EMOJIS['warning']} <b>Товар заканчивается:</b> {product[1]}\nОсталось: {available} (порог {threshold})"
+    await bot.send_message(ADMIN_ID, text, parse_mode=ParseMode.HTML)
+
+stock_alerts = StockAlerts(low_stock_threshold, report_low_stock)
+
+# Хранилище для отслеживания платежей
+payments = PaymentStore(
+    check_schedule=((float('inf'), PAYMENT_POLL_FALLBACK_INTERVAL),) if CRYPTO_WEBHOOK_PORT else PAYMENT_CHECK_SCHEDULE,
+    on_stock_change=stock_alerts.observe
+)
+
+proxy_checker = ProxyHealthChecker(PROXY_CHECK_CONCURRENCY, PROXY_CHECK_INTERVAL, target=PROXY_CHECK_TARGET,
+                                   on_stock_change=stock_alerts.observe)
+
+# Начисление реферальных
+def _book_referral_commission(c, user_id, purchase_amount):
+    """
+    Записывает комиссию рефереру в рамках транзакции.
+    Возвращает (referrer_id, commission, referrer_blocked) или None, если реферера нет
+    """
+    # Получаем информацию о реферере
+    result = c.execute('''SELECT u.referred_by, r.is_blocked
+                          FROM users u
+                          JOIN users r ON r.user_id = u.referred_by
+                          WHERE u.user_id = ?''', (user_id,)).fetchone()
     
-    # Получаем информацию о товаре
-    c.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = c.fetchone()
+    if not result:
+        return None
     
-    if not product:
-        logger.error(f"Товар {product_id} не найден")
-        conn.close()
-        return
+    referrer_id, referrer_blocked = result
+    commission = purchase_amount * (REFERRAL_PERCENT / 100)
+    
+    # Обновляем баланс реферера
+    c.execute('''UPDATE users 
+                 SET balance = balance + ?, referral_earnings = referral_earnings + ? 
+                 WHERE user_id = ?''',
+              (commission, commission, referrer_id))
+    
+    # Записываем транзакцию
+    c.execute('''INSERT INTO referral_transactions 
+                 (referrer_id, referred_id, purchase_amount, commission, date, status)
+                 VALUES (?, ?, ?, ?, ?, ?)''',
+              (referrer_id, user_id, purchase_amount, commission, 
+               datetime.now().strftime(DATE_FORMAT), 'completed'))
+    _add_daily_stats(c, referrals=1, commissions=commission)
+    
+    return referrer_id, commission, referrer_blocked
+
+def _referral_commission_message(purchase_amount, commission):
+    return (
+        f"{GREEN_EMOJIS['money']} <b>Реферальное вознаграждение!</b>\n\n"
+        f"Ваш друг совершил покупку на {purchase_amount}₽\n"
+        f"Вам начислено: {commission:.2f}₽ ({REFERRAL_PERCENT}%)\n\n"
+        f"Текущий баланс можно посмотреть в профиле."
+    )
+
+# Выдача товара после оплаты
+ITEM_TABLES = {
+    'proxy': ('proxy_items', 'proxy_data'),
+    'vpn': ('vpn_items', 'vpn_data'),
+}
+
+def _claim_item(c, kind, product_id, user_id, reserved=0):
+    """
+    Атомарно забирает одну свободную позицию товара одним UPDATE ... RETURNING.
+    Каждая позиция выдается ровно один раз, даже при параллельной оплате.
+    reserved - позиция была зарезервирована под счет, резерв расходуется.
+    Возвращает (id, данные, новый остаток в продаже) или None
+    """
+    table, data_column = ITEM_TABLES[kind]
+    item = c.execute(f'''UPDATE {table} 
+                          SET is_available = 0, used_by = ?, used_date = ? 
+                          WHERE id = (SELECT id FROM {table} 
+                                      WHERE product_id = ? AND is_available = 1 
+                                      LIMIT 1)
+                            AND is_available = 1
+                          RETURNING id, {data_column}''',
+                     (user_id, datetime.now().strftime(DATE_FORMAT), product_id)).fetchone()
+    
+    if not item:
+        return None
     
-    # Начисляем реферальные
-    await add_referral_commission(user_id, amount_rub)
+    # Счетчик наличия меняется в той же транзакции; остаток в продаже нужен для уведомлений
+    stock = c.execute('''UPDATE product_stock SET available = available - 1, reserved = MAX(reserved - ?, 0)
+                         WHERE product_id = ? RETURNING MAX(available - reserved, 0)''',
+                      (1 if reserved else 0, product_id)).fetchone()
+    return item[0], item[1], stock[0] if stock else 0
+
+def _issue_item(c, user_id, product, amount_rub, reserved=0):
+    """
+    Закрепляет единицу товара за пользователем и записывает покупку.
+    Возвращает (данные товара, дата окончания, новый остаток) или None, если товара нет
+    """
+    product_id = product[0]
+    expiry = None
     
     # Определяем тип товара и выдаем соответствующие данные
     if 'proxy' in product[2]:
         # Выдаем прокси
-        c.execute('''SELECT id, proxy_data FROM proxy_items 
-                     WHERE product_id = ? AND is_available = 1 
-                     LIMIT 1''', (product_id,))
-        item = c.fetchone()
+        item = _claim_item(c, 'proxy', product_id, user_id, reserved)
+        
+        if not item:
+            return None
+        
+        # Записываем покупку
+        c.execute('''INSERT INTO purchases 
+                     (user_id, product_id, proxy_item_id, purchase_date, status, data, price_rub)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  (user_id, product_id, item[0],
+                   datetime.now().strftime(DATE_FORMAT),
+                   'active', item[1], amount_rub))
         
-        if item:
-            # Помечаем как использованное
-            c.execute('''UPDATE proxy_items 
-                         SET is_available = 0, used_by = ?, used_date = ? 
-                         WHERE id = ?''',
-                      (user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), item[0]))
-            
-            # Записываем покупку
-            c.execute('''INSERT INTO purchases 
-                         (user_id, product_id, proxy_item_id, purchase_date, status, data, price_rub)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (user_id, product_id, item[0],
-                       datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                       'active', item[1], amount_rub))
-            
-            data_to_send = item[1]
-            product_type = "proxy"
-            instruction_url = product[8] or f"{INSTRUCTION_SITE}/#proxy"
-            
     else:  # VPN
         # Выдаем VPN
-        c.execute('''SELECT id, vpn_data FROM vpn_items 
-                     WHERE product_id = ? AND is_available = 1 
-                     LIMIT 1''', (product_id,))
-        item = c.fetchone()
+        item = _claim_item(c, 'vpn', product_id, user_id, reserved)
         
-        if item:
-            # Определяем срок действия
-            if product[2] == 'vpn_3days':
-                expiry = datetime.now() + timedelta(days=3)
-            else:
-                expiry = datetime.now() + timedelta(days=30)
-            
-            # Помечаем как использованное
-            c.execute('''UPDATE vpn_items 
-                         SET is_available = 0, used_by = ?, used_date = ? 
-                         WHERE id = ?''',
-                      (user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), item[0]))
-            
-            # Записываем покупку
-            c.execute('''INSERT INTO purchases 
-                         (user_id, product_id, purchase_date, expiry_date, status, data, price_rub)
-                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (user_id, product_id,
-                       datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                       expiry.strftime("%Y-%m-%d %H:%M:%S"),
-                       'active', item[1], amount_rub))
-            
-            data_to_send = item[1]
-            product_type = "vpn"
-            expiry_text = f"\n{GREEN_EMOJIS['info']} Срок действия до: {expiry.strftime('%d.%m.%Y')}"
-            instruction_url = product[8] or f"{INSTRUCTION_SITE}/#vpn"
+        if not item:
+            return None
+        
+        # Определяем срок действия
+        if product[2] == 'vpn_3days':
+            expiry = datetime.now() + timedelta(days=3)
+        else:
+            expiry = datetime.now() + timedelta(days=30)
+        
+        # Записываем покупку
+        c.execute('''INSERT INTO purchases 
+                     (user_id, product_id, purchase_date, expiry_date, status, data, price_rub)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  (user_id, product_id,
+                   datetime.now().strftime(DATE_FORMAT),
+                   expiry.strftime(DATE_FORMAT),
+                   'active', item[1], amount_rub))
     
-    conn.commit()
-    conn.close()
+    _add_daily_stats(c, product_id, purchases=1, revenue=amount_rub)
     
-    if item:
-        # Отправляем уведомление пользователю
-        try:
-            # Кнопка с инструкцией
-            builder = InlineKeyboardBuilder()
-            builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['leaf']} Инструкция по настройке", url=instruction_url))
-            
-            text = (
-                f"{GREEN_EMOJIS['success']} <b>Оплата получена!</b>\n\n"
-                f"📦 <b>Товар:</b> {product[1]}\n\n"
-                f"🔑 <b>Ваши данные:</b>\n<code>{data_to_send}</code>\n\n"
-                f"📝 <b>Инструкция:</b>\n{product[7] or 'Инструкция отсутствует'}"
-            )
-            
-            if product_type == "vpn":
-                text += expiry_text
-            
-            await bot.send_message(user_id, text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
-            logger.info(f"Товар выдан пользователю {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Не удалось отправить товар пользователю {user_id}: {e}")
+    return item[1], expiry, item[2]
+
+def _delivery_message(product, issued):
+    """
+    Сообщение с выданным товаром: (текст, клавиатура)
+    """
+    data_to_send, expiry, _ = issued
+    if 'proxy' in product[2]:
+        instruction_url = product[8] or f"{INSTRUCTION_SITE}/#proxy"
     else:
-        logger.error(f"Нет доступных товаров для продукта {product_id}")
-        await bot.send_message(user_id, f"{GREEN_EMOJIS['warning']} Произошла ошибка при выдаче товара. Обратитесь к администратору.")
+        instruction_url = product[8] or f"{INSTRUCTION_SITE}/#vpn"
+    
+    # Кнопка с инструкцией
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['leaf']} Инструкция по настройке", url=instruction_url))
+    
+    text = (
+        f"{GREEN_EMOJIS['success']} <b>Оплата получена!</b>\n\n"
+        f"📦 <b>Товар:</b> {product[1]}\n\n"
+        f"🔑 <b>Ваши данные:</b>\n<code>{html.escape(data_to_send)}</code>\n\n"
+        f"📝 <b>Инструкция:</b>\n{product[7] or 'Инструкция отсутствует'}"
+    )
+    
+    if expiry:
+        text += f"\n{GREEN_EMOJIS['info']} Срок действия до: {expiry.strftime('%d.%m.%Y')}"
+    
+    return text, builder.as_markup()
+
+def _settle_purchase(c, payment, product):
+    """
+    Проводит оплаченный счет одной транзакцией: статус платежа, выдача единицы
+    товара с расходом резерва, запись покупки, комиссия и баланс реферера. Сообщения покупателю
+    и рефереру ставятся в очередь в той же транзакции.
+    Возвращает (выданный товар или None, начисление рефереру или None)
+    или None, если счет уже проведен
+    """
+    user_id = payment['user_id']
+    amount_rub = payment['amount_rub']
+    if not update_payment_status(c, payment['invoice_id'], 'paid'):
+        return None
+    
+    issued = _issue_item(c, user_id, product, amount_rub, payment['reserved']) if product else None
+    if issued:
+        text, markup = _delivery_message(product, issued)
+        enqueue(c, user_id, text, ParseMode.HTML, markup)
+    else:
+        if payment['reserved']:
+            release_item(c, payment['product_id'])
+        enqueue(c, user_id, f"{GREEN_EMOJIS['warning']} Произошла ошибка при выдаче товара. Обратитесь к администратору.")
+    
+    booked = _book_referral_commission(c, user_id, amount_rub)
+    if booked:
+        referrer_id, commission, referrer_blocked = booked
+        # Рефереру, заблокировавшему бота, не пишем
+        if not referrer_blocked:
+            enqueue(c, referrer_id, _referral_commission_message(amount_rub, commission), ParseMode.HTML)
+    return issued, booked
+
+# Имя бота для реферальных ссылок, определяется один раз при запуске
+bot_username = None
+
+async def get_bot_username():
+    global bot_username
+    if bot_username is None:
+        bot_username = (await bot.get_me()).username
+    return bot_username
 
 # Главное меню (зеленый дизайн)
+# Клавиатуры не меняются, поэтому строятся один раз и переиспользуются
+@lru_cache(maxsize=None)
 def get_main_keyboard():
     builder = ReplyKeyboardBuilder()
     builder.add(KeyboardButton(text=f"{GREEN_EMOJIS['cart']} Купить прокси"))
@@ -523,11 +709,13 @@ def get_main_keyboard():
     return builder.as_markup(resize_keyboard=True)
 
 # Инлайн клавиатуры
+@lru_cache(maxsize=None)
 def back_button(callback_data="back_to_main"):
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['back']} Назад", callback_data=callback_data))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def admin_keyboard():
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -546,45 +734,72 @@ def admin_keyboard():
         InlineKeyboardButton(text=f"{GREEN_EMOJIS['gift']} Бесплатные ключи", callback_data="admin_free_keys"),
         InlineKeyboardButton(text=f"{GREEN_EMOJIS['settings']} Управление товарами", callback_data="admin_manage_products")
     )
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['warning']} Пороги остатков", callback_data="admin_stock_thresholds"))
     builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['back']} Назад", callback_data="back_to_main"))
     return builder.as_markup()
 
+HELP_TEXT = (
+    f"{GREEN_EMOJIS['monkey']} <b>Dev Monkey - Помощь</b>\n\n"
+    f"{GREEN_EMOJIS['cart']} <b>Купить прокси</b> - приобрести прокси для любых задач\n"
+    f"{GREEN_EMOJIS['lock']} <b>Купить VPN</b> - безопасный доступ в интернет\n"
+    f"{GREEN_EMOJIS['profile']} <b>Профиль</b> - история покупок, реферальная ссылка и баланс\n"
+    f"{GREEN_EMOJIS['gift']} <b>Бесплатные</b> - получить бесплатный прокси или VPN\n\n"
+    f"{GREEN_EMOJIS['gift']} <b>Реферальная система:</b>\n"
+    f"• Приглашайте друзей и получайте {REFERRAL_PERCENT}% от их покупок\n"
+    f"• Реферальная ссылка в профиле\n\n"
+    f"{GREEN_EMOJIS['leaf']} <b>Инструкции:</b>\n"
+    f"• Прокси: {INSTRUCTION_SITE}/#proxy\n"
+    f"• VPN: {INSTRUCTION_SITE}/#vpn\n\n"
+    f"По всем вопросам обращайтесь к администратору."
+)
+
+@lru_cache(maxsize=None)
+def help_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['leaf']} Инструкция по прокси", url=f"{INSTRUCTION_SITE}/#proxy"))
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['leaf']} Инструкция по VPN", url=f"{INSTRUCTION_SITE}/#vpn"))
+    return builder.as_markup()
+
+async def warm_up():
+    """
+    Заранее получает имя бота и строит статические клавиатуры,
+    чтобы обработчики не тратили на это время
+    """
+    await get_bot_username()
+    get_main_keyboard()
+    admin_keyboard()
+    help_keyboard()
+    for callback_data in ("back_to_main", "back_to_proxy", "back_to_vpn", "admin", "admin_free_keys"):
+        back_button(callback_data)
+    stats_keyboard()
+
 # Проверка админа
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
 # ============= ФУНКЦИИ ПРОВЕРКИ НАЛИЧИЯ =============
 
-def get_available_proxy_count(product_id):
+async def get_available_count(product_id):
     """
-    Получить количество доступных прокси для товара
+    Получить количество доступных позиций товара (прокси или VPN)
+    без зарезервированных под открытые счета
     """
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM proxy_items WHERE product_id = ? AND is_available = 1", (product_id,))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+    row = await db.fetchone("SELECT MAX(available - reserved, 0) FROM product_stock WHERE product_id = ?",
+                            (product_id,))
+    return row[0] if row else 0
 
-def get_available_vpn_count(product_id):
+async def get_stock_levels():
     """
-    Получить количество доступных VPN для товара
+    Получить остатки всех товаров одним запросом без резервов: {product_id: количество}
     """
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM vpn_items WHERE product_id = ? AND is_available = 1", (product_id,))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+    rows = await db.fetchall("SELECT product_id, MAX(available - reserved, 0) FROM product_stock")
+    return dict(rows)
 
-def check_product_availability(product_id, product_type):
+async def check_product_availability(product_id, product_type):
     """
     Проверяет, есть ли хотя бы один доступный экземпляр товара
     """
-    if 'proxy' in product_type:
-        return get_available_proxy_count(product_id) > 0
-    else:
-        return get_available_vpn_count(product_id) > 0
+    return await get_available_count(product_id) > 0
 
 # ============= ОБРАБОТЧИКИ КОМАНД =============
 
@@ -598,51 +813,38 @@ async def cmd_start(message: Message):
     # Проверяем, есть ли реферальный код в команде
     args = message.text.split()
     referred_by = None
+    referrer_blocked = False
     if len(args) > 1:
         referral_code = args[1]
         # Ищем пользователя с таким реферальным кодом
-        conn = sqlite3.connect('dev_monkey.db')
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM users WHERE referral_code = ?", (referral_code,))
-        result = c.fetchone()
+        result = await db.fetchone("SELECT user_id, is_blocked FROM users WHERE referral_code = ?", (referral_code,))
         if result and result[0] != user_id:
-            referred_by = result[0]
-        conn.close()
-    
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
+            referred_by, referrer_blocked = result
     
     # Проверяем, существует ли пользователь
-    c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    user = c.fetchone()
+    user = await db.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
     
     if not user:
         # Генерируем реферальный код для нового пользователя
         referral_code = generate_referral_code(user_id)
         
-        # Добавляем нового пользователя
-        c.execute('''INSERT INTO users 
-                     (user_id, username, first_name, joined_date, referral_code, referred_by) 
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (user_id, username, first_name, 
-                   datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                   referral_code, referred_by))
-        
         # Если пользователь пришел по реферальной ссылке, уведомляем реферера
-        if referred_by:
-            try:
-                await bot.send_message(
-                    referred_by,
-                    f"{GREEN_EMOJIS['gift']} <b>Новый реферал!</b>\n\n"
-                    f"Пользователь {first_name} (@{username}) присоединился по вашей ссылке.\n"
-                    f"Вы получите {REFERRAL_PERCENT}% от его покупок!",
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить реферера {referred_by}: {e}")
-    
-    conn.commit()
-    conn.close()
+        referrer_notice = None
+        if referred_by and not referrer_blocked:
+            referrer_notice = (
+                f"{GREEN_EMOJIS['gift']} <b>Новый реферал!</b>\n\n"
+                f"Пользователь {first_name} (@{username}) присоединился по вашей ссылке.\n"
+                f"Вы получите {REFERRAL_PERCENT}% от его покупок!"
+            )
+        
+        # Добавляем нового пользователя
+        await db.transaction(_register_user, user_id, username, first_name, referral_code, referred_by, 0,
+                             referrer_notice)
+        if referrer_notice:
+            outbox_dispatcher.wake()
+    elif user[9]:
+        # Пользователь снова написал боту - ему снова можно писать
+        await db.execute("UPDATE users SET is_blocked = 0 WHERE user_id = ?", (user_id,))
     
     welcome_text = (
         f"{GREEN_EMOJIS['monkey']} <b>Добро пожаловать в Dev Monkey, {first_name}!</b>\n\n"
@@ -673,26 +875,7 @@ async def cmd_admin(message: Message):
 # Команда помощи
 @dp.message(Command("help"))
 async def cmd_help(message: Message):
-    help_text = (
-        f"{GREEN_EMOJIS['monkey']} <b>Dev Monkey - Помощь</b>\n\n"
-        f"{GREEN_EMOJIS['cart']} <b>Купить прокси</b> - приобрести прокси для любых задач\n"
-        f"{GREEN_EMOJIS['lock']} <b>Купить VPN</b> - безопасный доступ в интернет\n"
-        f"{GREEN_EMOJIS['profile']} <b>Профиль</b> - история покупок, реферальная ссылка и баланс\n"
-        f"{GREEN_EMOJIS['gift']} <b>Бесплатные</b> - получить бесплатный прокси или VPN\n\n"
-        f"{GREEN_EMOJIS['gift']} <b>Реферальная система:</b>\n"
-        f"• Приглашайте друзей и получайте {REFERRAL_PERCENT}% от их покупок\n"
-        f"• Реферальная ссылка в профиле\n\n"
-        f"{GREEN_EMOJIS['leaf']} <b>Инструкции:</b>\n"
-        f"• Прокси: {INSTRUCTION_SITE}/#proxy\n"
-        f"• VPN: {INSTRUCTION_SITE}/#vpn\n\n"
-        f"По всем вопросам обращайтесь к администратору."
-    )
-    
-    builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['leaf']} Инструкция по прокси", url=f"{INSTRUCTION_SITE}/#proxy"))
-    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['leaf']} Инструкция по VPN", url=f"{INSTRUCTION_SITE}/#vpn"))
-    
-    await message.answer(help_text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
+    await message.answer(HELP_TEXT, parse_mode=ParseMode.HTML, reply_markup=help_keyboard())
 
 # ============= ОБРАБОТЧИКИ ТЕКСТОВЫХ СООБЩЕНИЙ =============
 
@@ -716,16 +899,15 @@ async def menu_free(message: Message):
 
 # Показать прокси товары
 async def show_proxy_products(message: Message):
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE type LIKE 'proxy%' AND is_active=1")
-    products = c.fetchall()
-    conn.close()
+    products = await catalog.active('proxy')
     
     if not products:
         await message.answer(f"{GREEN_EMOJIS['warning']} Прокси временно отсутствуют")
         return
     
+    # Остатки по всем товарам одним запросом
+    stock = await get_stock_levels()
+    
     builder = InlineKeyboardBuilder()
     for product in products:
         product_id = product[0]
@@ -733,7 +915,7 @@ async def show_proxy_products(message: Message):
         product_price = product[3]
         
         # Проверяем наличие
-        available_count = get_available_proxy_count(product_id)
+        available_count = stock.get(product_id, 0)
         
         if available_count > 0:
             status = f"{GREEN_EMOJIS['success']} {available_count} шт"
@@ -755,16 +937,15 @@ async def show_proxy_products(message: Message):
 
 # Показать VPN товары
 async def show_vpn_products(message: Message):
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE type LIKE 'vpn%' AND is_active=1")
-    products = c.fetchall()
-    conn.close()
+    products = await catalog.active('vpn')
     
     if not products:
         await message.answer(f"{GREEN_EMOJIS['warning']} VPN временно отсутствуют")
         return
     
+    # Остатки по всем товарам одним запросом
+    stock = await get_stock_levels()
+    
     builder = InlineKeyboardBuilder()
     for product in products:
         product_id = product[0]
@@ -772,7 +953,7 @@ async def show_vpn_products(message: Message):
         product_price = product[3]
         
         # Проверяем наличие
-        available_count = get_available_vpn_count(product_id)
+        available_count = stock.get(product_id, 0)
         
         if available_count > 0:
             status = f"{GREEN_EMOJIS['success']} {available_count} шт"
@@ -802,17 +983,13 @@ async def no_stock_handler(callback: CallbackQuery):
 async def view_proxy_product(callback: CallbackQuery):
     product_id = int(callback.data.split("_")[2])
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = c.fetchone()
-    conn.close()
+    product = await catalog.get(product_id)
     
     if not product:
         await callback.answer("Товар не найден")
         return
     
-    available_count = get_available_proxy_count(product_id)
+    available_count = await get_available_count(product_id)
     
     # Кнопка с инструкцией
     builder = InlineKeyboardBuilder()
@@ -843,17 +1020,13 @@ async def view_proxy_product(callback: CallbackQuery):
 async def view_vpn_product(callback: CallbackQuery):
     product_id = int(callback.data.split("_")[2])
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = c.fetchone()
-    conn.close()
+    product = await catalog.get(product_id)
     
     if not product:
         await callback.answer("Товар не найден")
         return
     
-    available_count = get_available_vpn_count(product_id)
+    available_count = await get_available_count(product_id)
     
     # Кнопка с инструкцией
     builder = InlineKeyboardBuilder()
@@ -881,143 +1054,184 @@ async def view_vpn_product(callback: CallbackQuery):
 
 # ============= ПОКУПКА ТОВАРОВ =============
 
-# Покупка прокси (создание счета)
-@dp.callback_query(F.data.startswith("buy_proxy_"))
-async def buy_proxy(callback: CallbackQuery):
-    product_id = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    
-    # Проверяем наличие
-    available_count = get_available_proxy_count(product_id)
-    if available_count == 0:
-        await callback.answer(f"{GREEN_EMOJIS['warning']} Товар закончился", show_alert=True)
-        return
-    
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = c.fetchone()
-    conn.close()
+# Создание счета с резервом товара
+OUT_OF_STOCK = 'out_of_stock'
+IN_PROGRESS = 'in_progress'
+
+# (user_id, product_id), для которых сейчас создается счет
+invoices_in_progress = set()
+
+async def _release_reservation(product_id):
+    available = await db.run(release_item, product_id)
+    if available is not None:
+        stock_alerts.observe(product_id, available)
+
+async def _create_reserved_invoice(product, user_id, kind):
+    product_id = product[0]
+    available = await db.run(reserve_item, product_id)
+    if available is None:
+        return OUT_OF_STOCK
+    stock_alerts.observe(product_id, available)
     
     # Создаем счет в Crypto Bot
-    payload = f"proxy_{product_id}_{user_id}_{datetime.now().timestamp()}"
-    invoice = create_crypto_invoice(
+    payload = f"{kind}_{product_id}_{user_id}_{datetime.now().timestamp()}"
+    invoice = await create_crypto_invoice(
         amount_usdt=product[4],
         description=f"Покупка: {product[1]}",
         payload=payload
     )
     
+    payment = None
     if invoice:
-        # Сохраняем информацию о платеже
-        pending_payments[user_id] = {
-            'invoice_id': invoice['invoice_id'],
-            'product_id': product_id,
-            'amount_rub': product[3],
-            'status': 'pending',
-            'created_at': datetime.now(),
-            'expires_at': datetime.now() + timedelta(minutes=PAYMENT_EXPIRY_MINUTES),
-            'pay_url': invoice['pay_url']
-        }
-        
-        builder = InlineKeyboardBuilder()
-        builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['money']} Оплатить", url=invoice['pay_url']))
-        builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['refresh']} Проверить оплату", callback_data=f"check_payment_{product_id}"))
-        builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['back']} Отмена", callback_data="back_to_proxy"))
-        
-        await callback.message.edit_text(
-            f"{GREEN_EMOJIS['leaf']} <b>Счет на оплату</b>\n\n"
-            f"Товар: {product[1]}\n"
-            f"Сумма: {product[3]}₽ ({product[4]:.4f} USDT)\n\n"
-            f"⏳ Счет действителен {PAYMENT_EXPIRY_MINUTES} минут\n\n"
-            f"После оплаты нажмите кнопку 'Проверить оплату'",
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
-    else:
-        await callback.message.edit_text(
-            f"{GREEN_EMOJIS['warning']} Ошибка при создании счета. Попробуйте позже.",
-            reply_markup=back_button("back_to_proxy")
-        )
+        try:
+            payment = await payments.create(
+                invoice_id=invoice['invoice_id'],
+                user_id=user_id,
+                product_id=product_id,
+                amount_rub=product[3],
+                pay_url=invoice['pay_url'],
+                expires_at=datetime.now() + timedelta(minutes=PAYMENT_EXPIRY_MINUTES),
+                reserved=True
+            )
+        except Exception as e:
+            logger.error(f"Не удалось сохранить счет {invoice['invoice_id']}: {e}")
+            # Счет, о котором бот не знает, нельзя оставлять доступным для оплаты
+            await delete_crypto_invoice(invoice['invoice_id'])
     
-    await callback.answer()
+    if payment is None:
+        # Счет не создан - резерв больше не нужен
+        await _release_reservation(product_id)
+    return payment
 
-# Покупка VPN (создание счета)
-@dp.callback_query(F.data.startswith("buy_vpn_"))
-async def buy_vpn(callback: CallbackQuery):
+async def open_invoice(product, user_id, kind):
+    """
+    Счет на покупку товара под резерв одной единицы.
+    Открытый счет пользователя на этот же товар переиспользуется, поэтому
+    повторные нажатия "Купить" не держат несколько единиц.
+    Возвращает платеж, OUT_OF_STOCK, IN_PROGRESS или None при ошибке создания счета
+    """
+    payment = payments.find_open(user_id, product[0])
+    if payment:
+        return payment
+    
+    key = (user_id, product[0])
+    if key in invoices_in_progress:
+        return IN_PROGRESS
+    invoices_in_progress.add(key)
+    try:
+        return await _create_reserved_invoice(product, user_id, kind)
+    finally:
+        invoices_in_progress.discard(key)
+
+def _invoice_message(product, payment):
+    """
+    Сообщение со счетом на оплату: (текст, клавиатура)
+    """
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['money']} Оплатить", url=payment['pay_url']))
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['refresh']} Проверить оплату", callback_data=f"check_payment_{payment['invoice_id']}"))
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['back']} Отмена", callback_data=f"cancel_payment_{payment['invoice_id']}"))
+    
+    # Для переиспользованного счета показываем оставшееся время
+    minutes_left = max(1, math.ceil((payment['expires_at'] - datetime.now()).total_seconds() / 60))
+    text = (
+        f"{GREEN_EMOJIS['leaf']} <b>Счет на оплату</b>\n\n"
+        f"Товар: {product[1]}\n"
+        f"Сумма: {product[3]}₽ ({product[4]:.4f} USDT)\n\n"
+        f"⏳ Счет действителен {minutes_left} минут\n\n"
+        f"После оплаты нажмите кнопку 'Проверить оплату'"
+    )
+    return text, builder.as_markup()
+
+async def buy_product(callback: CallbackQuery, kind):
+    """
+    Выставляет счет на товар kind ('proxy' или 'vpn') из callback buy_{kind}_{product_id}
+    """
     product_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
     
-    # Проверяем наличие
-    available_count = get_available_vpn_count(product_id)
-    if available_count == 0:
-        await callback.answer(f"{GREEN_EMOJIS['warning']} Товар закончился", show_alert=True)
+    product = await catalog.get(product_id)
+    if not product:
+        await callback.answer("Товар не найден")
         return
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = c.fetchone()
-    conn.close()
+    payment = await open_invoice(product, user_id, kind)
     
-    # Создаем счет в Crypto Bot
-    payload = f"vpn_{product_id}_{user_id}_{datetime.now().timestamp()}"
-    invoice = create_crypto_invoice(
-        amount_usdt=product[4],
-        description=f"Покупка: {product[1]}",
-        payload=payload
-    )
+    if payment == OUT_OF_STOCK:
+        await callback.answer(f"{GREEN_EMOJIS['warning']} Товар закончился", show_alert=True)
+        return
+    if payment == IN_PROGRESS:
+        await callback.answer("⏳ Счет уже создается")
+        return
     
-    if invoice:
-        # Сохраняем информацию о платеже
-        pending_payments[user_id] = {
-            'invoice_id': invoice['invoice_id'],
-            'product_id': product_id,
-            'amount_rub': product[3],
-            'status': 'pending',
-            'created_at': datetime.now(),
-            'expires_at': datetime.now() + timedelta(minutes=PAYMENT_EXPIRY_MINUTES),
-            'pay_url': invoice['pay_url']
-        }
-        
-        builder = InlineKeyboardBuilder()
-        builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['money']} Оплатить", url=invoice['pay_url']))
-        builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['refresh']} Проверить оплату", callback_data=f"check_payment_{product_id}"))
-        builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['back']} Отмена", callback_data="back_to_vpn"))
-        
-        await callback.message.edit_text(
-            f"{GREEN_EMOJIS['leaf']} <b>Счет на оплату</b>\n\n"
-            f"Товар: {product[1]}\n"
-            f"Сумма: {product[3]}₽ ({product[4]:.4f} USDT)\n\n"
-            f"⏳ Счет действителен {PAYMENT_EXPIRY_MINUTES} минут\n\n"
-            f"После оплаты нажмите кнопку 'Проверить оплату'",
-            parse_mode=ParseMode.HTML,
-            reply_markup=builder.as_markup()
-        )
+    if payment:
+        text, markup = _invoice_message(product, payment)
+        await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
     else:
         await callback.message.edit_text(
             f"{GREEN_EMOJIS['warning']} Ошибка при создании счета. Попробуйте позже.",
-            reply_markup=back_button("back_to_vpn")
+            reply_markup=back_button(f"back_to_{kind}")
         )
     
     await callback.answer()
 
+# Покупка прокси (создание счета)
+@dp.callback_query(F.data.startswith("buy_proxy_"))
+async def buy_proxy(callback: CallbackQuery):
+    await buy_product(callback, 'proxy')
+
+# Покупка VPN (создание счета)
+@dp.callback_query(F.data.startswith("buy_vpn_"))
+async def buy_vpn(callback: CallbackQuery):
+    await buy_product(callback, 'vpn')
+
+# Отмена счета
+@dp.callback_query(F.data.startswith("cancel_payment_"))
+async def cancel_payment(callback: CallbackQuery):
+    invoice_id = int(callback.data.split("_")[2])
+    
+    payment_data = await payments.find(invoice_id)
+    if not payment_data or payment_data['user_id'] != callback.from_user.id:
+        await callback.answer(f"{GREEN_EMOJIS['warning']} Счет не найден", show_alert=True)
+        return
+    
+    if payment_data['status'] == 'pending':
+        # Сначала удаляем счет в Crypto Pay: после снятия резерва его нельзя оплатить.
+        # Оплаченный счет удалить нельзя - его проведет фоновая проверка
+        if not await delete_crypto_invoice(invoice_id):
+            await callback.answer(
+                f"{GREEN_EMOJIS['warning']} Не удалось отменить счет.\n"
+                "Если вы его уже оплатили, товар будет выдан автоматически.",
+                show_alert=True
+            )
+            return
+        if await payments.finish(payment_data, 'cancelled'):
+            logger.info(f"Платеж {invoice_id} пользователя {payment_data['user_id']} отменен")
+    
+    product = await catalog.get(payment_data['product_id'])
+    if product and 'vpn' in product[2]:
+        await show_vpn_products(callback.message)
+    else:
+        await show_proxy_products(callback.message)
+    await callback.answer("Счет отменен")
+
 # Проверка оплаты
 @dp.callback_query(F.data.startswith("check_payment_"))
 async def check_payment(callback: CallbackQuery):
-    product_id = int(callback.data.split("_")[2])
+    invoice_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
     
-    if user_id not in pending_payments:
+    payment_data = await payments.find(invoice_id)
+    
+    if not payment_data or payment_data['user_id'] != user_id:
         await callback.answer(f"{GREEN_EMOJIS['warning']} Активный платеж не найден", show_alert=True)
         return
     
-    payment_data = pending_payments[user_id]
-    
     if payment_data['status'] == 'paid':
         await callback.answer(f"{GREEN_EMOJIS['success']} Платеж уже обработан", show_alert=True)
         return
     
-    if payment_data['status'] == 'expired':
+    if payment_data['status'] in ['expired', 'cancelled']:
         await callback.message.edit_text(
             f"{GREEN_EMOJIS['warning']} Срок действия счета истек.\n"
             "Создайте новый заказ.",
@@ -1027,13 +1241,11 @@ async def check_payment(callback: CallbackQuery):
         return
     
     # Проверяем статус в API
-    status = check_invoice_status(payment_data['invoice_id'])
+    status = await check_invoice_status(payment_data['invoice_id'])
     
     if status == 'paid':
-        payment_data['status'] = 'paid'
-        
-        # Выдаем товар
-        await deliver_product(user_id, product_id, payment_data['amount_rub'])
+        # Товар мог быть уже выдан через webhook или фоновую проверку, пока шел запрос
+        await confirm_payment(payment_data)
         
         await callback.message.edit_text(
             f"{GREEN_EMOJIS['success']} <b>Оплата успешно получена!</b>\n\n"
@@ -1052,6 +1264,9 @@ async def check_payment(callback: CallbackQuery):
             show_alert=True
         )
     else:
+        if status in ['expired', 'cancelled']:
+            await payments.finish(payment_data, status)
+        
         await callback.answer(
             f"{GREEN_EMOJIS['warning']} Платеж не найден или истек.\n"
             "Создайте новый заказ.",
@@ -1061,34 +1276,32 @@ async def check_payment(callback: CallbackQuery):
 # ============= ПРОФИЛЬ =============
 
 # Профиль с реферальной информацией
-async def show_profile(message: Message):
-    user_id = message.from_user.id
-    
-    conn = sqlite3.connect('dev_monkey.db')
+def _load_profile(conn, user_id):
     c = conn.cursor()
     
     # Информация о пользователе
     c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     user = c.fetchone()
     
-    # История покупок
+    # Последние покупки
     c.execute('''SELECT p.name, pu.purchase_date, pu.expiry_date, pu.status, pu.data, pu.price_rub
                  FROM purchases pu
                  JOIN products p ON pu.product_id = p.id
                  WHERE pu.user_id = ?
-                 ORDER BY pu.purchase_date DESC''', (user_id,))
+                 ORDER BY pu.purchase_date DESC, pu.id DESC
+                 LIMIT ?''', (user_id, PROFILE_PURCHASES_LIMIT))
     purchases = c.fetchall()
     
-    # Бесплатные ключи
-    c.execute("SELECT type, key, used_date FROM free_keys WHERE used_by = ?", (user_id,))
+    # Последние бесплатные ключи
+    c.execute('''SELECT type, key, used_date FROM free_keys
+                 WHERE used_by = ?
+                 ORDER BY used_date DESC
+                 LIMIT ?''', (user_id, PROFILE_FREE_KEYS_LIMIT))
     free_keys = c.fetchall()
     
-    # Реферальная статистика
-    c.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
-    referrals_count = c.fetchone()[0]
-    
-    c.execute("SELECT SUM(commission) FROM referral_transactions WHERE referrer_id = ?", (user_id,))
-    total_earned = c.fetchone()[0] or 0
+    # Реферальная статистика: счетчики хранятся в строке пользователя
+    referrals_count = user[11]
+    total_earned = user[8] or 0
     
     c.execute('''SELECT u.username, u.first_name, rt.purchase_amount, rt.commission, rt.date
                  FROM referral_transactions rt
@@ -1097,10 +1310,16 @@ async def show_profile(message: Message):
                  ORDER BY rt.date DESC LIMIT 5''', (user_id,))
     recent_referrals = c.fetchall()
     
-    conn.close()
+    return user, purchases, free_keys, referrals_count, total_earned, recent_referrals
+
+async def show_profile(message: Message):
+    user_id = message.from_user.id
+    
+    (user, purchases, free_keys, referrals_count,
+     total_earned, recent_referrals) = await db.run(_load_profile, user_id)
     
     # Реферальная ссылка
-    bot_username = (await bot.get_me()).username
+    bot_username = await get_bot_username()
     referral_link = f"https://t.me/{bot_username}?start={user[6]}"
     
     profile_text = (
@@ -1125,7 +1344,7 @@ async def show_profile(message: Message):
     
     profile_text += f"{GREEN_EMOJIS['cart']} <b>Последние покупки:</b>\n"
     if purchases:
-        for p in purchases[:5]:
+        for p in purchases:
             status_emoji = f"{GREEN_EMOJIS['success']}" if p[3] == 'active' else f"{GREEN_EMOJIS['warning']}"
             profile_text += f"{status_emoji} {p[0]} - {p[5]}₽ ({p[1]})\n"
     else:
@@ -1141,21 +1360,92 @@ async def show_profile(message: Message):
     # Кнопка для копирования ссылки
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['copy']} Скопировать реферальную ссылку", callback_data="copy_referral"))
+    if purchases:
+        builder.row(InlineKeyboardButton(text="📜 История покупок", callback_data="history"))
     
     await message.answer(profile_text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
 
+# История покупок
+def _load_purchase_page(conn, user_id, direction=None, cursor_id=None):
+    """
+    Страница истории покупок от новых к старым.
+    Курсор - покупка на краю текущей страницы: 'older' - страница после нее,
+    'newer' - перед ней. Сравнение по ключу (purchase_date, id) идет по индексу,
+    без OFFSET. Возвращает (покупки, есть старше, есть новее)
+    """
+    limit = PURCHASE_HISTORY_PAGE_SIZE
+    query = '''SELECT pu.id, p.name, pu.purchase_date, pu.expiry_date, pu.status, pu.data, pu.price_rub
+               FROM purchases pu
+               JOIN products p ON pu.product_id = p.id
+               WHERE pu.user_id = ?'''
+    
+    if direction == 'newer':
+        rows = conn.execute(query + '''
+               AND (pu.purchase_date, pu.id) > (SELECT purchase_date, id FROM purchases WHERE id = ?)
+               ORDER BY pu.purchase_date, pu.id
+               LIMIT ?''', (user_id, cursor_id, limit + 1)).fetchall()
+        has_newer = len(rows) > limit
+        return rows[:limit][::-1], True, has_newer
+    
+    if direction == 'older':
+        rows = conn.execute(query + '''
+               AND (pu.purchase_date, pu.id) < (SELECT purchase_date, id FROM purchases WHERE id = ?)
+               ORDER BY pu.purchase_date DESC, pu.id DESC
+               LIMIT ?''', (user_id, cursor_id, limit + 1)).fetchall()
+        return rows[:limit], len(rows) > limit, True
+    
+    rows = conn.execute(query + '''
+           ORDER BY pu.purchase_date DESC, pu.id DESC
+           LIMIT ?''', (user_id, limit + 1)).fetchall()
+    return rows[:limit], len(rows) > limit, False
+
+@dp.callback_query(F.data.startswith("history"))
+async def purchase_history(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    
+    direction = cursor_id = None
+    if callback.data != "history":
+        _, direction, cursor_id = callback.data.split("_")
+        cursor_id = int(cursor_id)
+    
+    purchases, has_older, has_newer = await db.run(_load_purchase_page, user_id, direction, cursor_id)
+    
+    if not purchases:
+        await callback.answer("Покупок больше нет", show_alert=True)
+        return
+    
+    text = f"{GREEN_EMOJIS['cart']} <b>История покупок:</b>\n\n"
+    for p in purchases:
+        status_emoji = f"{GREEN_EMOJIS['success']}" if p[4] == 'active' else f"{GREEN_EMOJIS['warning']}"
+        text += f"{status_emoji} {p[1]} - {p[6]}₽ ({p[2]})\n<code>{p[5]}</code>\n"
+        if p[3]:
+            text += f"Действует до: {p[3]}\n"
+        text += "\n"
+    
+    builder = InlineKeyboardBuilder()
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"history_newer_{purchases[0][0]}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton(text="Старше ▶️", callback_data=f"history_older_{purchases[-1][0]}"))
+    if buttons:
+        builder.row(*buttons)
+    
+    if callback.data == "history":
+        # Первая страница - отдельным сообщением, профиль остается на месте
+        await callback.message.answer(text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
+    else:
+        await callback.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=builder.as_markup())
+    await callback.answer()
+
 # Копирование реферальной ссылки
 @dp.callback_query(F.data == "copy_referral")
 async def copy_referral(callback: CallbackQuery):
     user_id = callback.from_user.id
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT referral_code FROM users WHERE user_id = ?", (user_id,))
-    referral_code = c.fetchone()[0]
-    conn.close()
+    referral_code = (await db.fetchone("SELECT referral_code FROM users WHERE user_id = ?", (user_id,)))[0]
     
-    bot_username = (await bot.get_me()).username
+    bot_username = await get_bot_username()
     referral_link = f"https://t.me/{bot_username}?start={referral_code}"
     
     await callback.answer(
@@ -1177,12 +1467,7 @@ async def show_free_menu(message: Message):
         reply_markup=builder.as_markup()
     )
 
-@dp.callback_query(F.data.in_(["free_proxy", "free_vpn"]))
-async def get_free_key(callback: CallbackQuery):
-    key_type = "proxy" if callback.data == "free_proxy" else "vpn"
-    user_id = callback.from_user.id
-    
-    conn = sqlite3.connect('dev_monkey.db')
+def _claim_free_key(conn, key_type, user_id):
     c = conn.cursor()
     
     # Ищем неиспользованный ключ
@@ -1196,9 +1481,18 @@ async def get_free_key(callback: CallbackQuery):
         c.execute('''UPDATE free_keys 
                      SET is_available = 0, used_by = ?, used_date = ? 
                      WHERE id = ?''',
-                  (user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), key[0]))
-        conn.commit()
-        
+                  (user_id, datetime.now().strftime(DATE_FORMAT), key[0]))
+    
+    return key
+
+@dp.callback_query(F.data.in_(["free_proxy", "free_vpn"]))
+async def get_free_key(callback: CallbackQuery):
+    key_type = "proxy" if callback.data == "free_proxy" else "vpn"
+    user_id = callback.from_user.id
+    
+    key = await db.transaction(_claim_free_key, key_type, user_id)
+    
+    if key:
         instruction_url = f"{INSTRUCTION_SITE}/#{key_type}"
         
         builder = InlineKeyboardBuilder()
@@ -1218,70 +1512,46 @@ async def get_free_key(callback: CallbackQuery):
             reply_markup=back_button("back_to_main")
         )
     
-    conn.close()
     await callback.answer()
 
 # ============= АДМИН ПАНЕЛЬ =============
 
 # Статистика
-@dp.callback_query(F.data == "admin_stats")
-async def admin_stats(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        await callback.answer("У вас нет доступа", show_alert=True)
-        return
-    
-    conn = sqlite3.connect('dev_monkey.db')
+def _build_stats_text(conn):
     c = conn.cursor()
     
-    # Общая статистика
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM users WHERE joined_date >= date('now', '-1 day')")
-    new_users_today = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM users WHERE referred_by IS NOT NULL")
-    users_with_referral = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM purchases WHERE status = 'active'")
-    active_purchases = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM purchases WHERE date(purchase_date) = date('now')")
-    purchases_today = c.fetchone()[0]
-    
-    c.execute('''SELECT SUM(price_rub) FROM purchases 
-                 WHERE date(purchase_date) = date('now')''')
-    revenue_today = c.fetchone()[0] or 0
-    
-    c.execute('''SELECT SUM(price_rub) FROM purchases''')
-    total_revenue = c.fetchone()[0] or 0
-    
-    # Реферальная статистика
-    c.execute("SELECT SUM(commission) FROM referral_transactions")
-    total_commission_paid = c.fetchone()[0] or 0
-    
-    c.execute("SELECT COUNT(*) FROM referral_transactions WHERE date(date) = date('now')")
-    referrals_today = c.fetchone()[0]
+    # Итоги за сегодня и за все время из дневной статистики
+    today = datetime.now().strftime("%Y-%m-%d")
+    c.execute('''SELECT day, SUM(new_users), SUM(referred_users), SUM(purchases),
+                        SUM(revenue), SUM(referrals), SUM(commissions)
+                 FROM daily_stats
+                 WHERE day IN (?, ?)
+                 GROUP BY day''', (today, STATS_ALL_TIME))
+    totals = {row[0]: row[1:] for row in c.fetchall()}
+    new_users_today, _, purchases_today, revenue_today, referrals_today, _ = totals.get(today, (0,) * 6)
+    total_users, users_with_referral, active_purchases, total_revenue, _, total_commission_paid = \
+        totals.get(STATS_ALL_TIME, (0,) * 6)
     
     # Статистика по товарам
-    c.execute('''SELECT p.name, COUNT(pu.id), SUM(pu.price_rub)
-                 FROM products p
-                 LEFT JOIN purchases pu ON p.id = pu.product_id
-                 GROUP BY p.id''')
+    c.execute('''SELECT p.name, s.purchases, s.revenue
+                 FROM daily_stats s
+                 JOIN products p ON p.id = s.product_id
+                 WHERE s.day = ?
+                 ORDER BY p.id''', (STATS_ALL_TIME,))
     products_stats = c.fetchall()
     
     # Статистика по наличию
-    c.execute("SELECT COUNT(*) FROM proxy_items WHERE is_available = 1")
-    available_proxy = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM vpn_items WHERE is_available = 1")
-    available_vpn = c.fetchone()[0]
+    c.execute('''SELECT SUM(CASE WHEN p.type LIKE 'proxy%' THEN s.available ELSE 0 END),
+                        SUM(CASE WHEN p.type LIKE 'proxy%' THEN 0 ELSE s.available END)
+                 FROM product_stock s
+                 JOIN products p ON p.id = s.product_id''')
+    available_proxy, available_vpn = c.fetchone()
+    available_proxy = available_proxy or 0
+    available_vpn = available_vpn or 0
     
     c.execute("SELECT COUNT(*) FROM free_keys WHERE is_available = 1")
     available_free = c.fetchone()[0]
     
-    conn.close()
-    
     stats_text = (
         f"{GREEN_EMOJIS['stats']} <b>Статистика</b>\n\n"
         f"👥 <b>Пользователи:</b>\n"
@@ -1313,9 +1583,109 @@ async def admin_stats(callback: CallbackQuery):
         if p[1] > 0:
             stats_text += f"• {p[0]}: {p[1]} шт (на {p[2]:.0f}₽)\n"
     
-    await callback.message.edit_text(stats_text, parse_mode=ParseMode.HTML, reply_markup=back_button("admin"))
+    return stats_text
+
+class StatsSnapshot:
+    """
+    Снимок статистики админа в памяти.
+    Пересчитывается фоновой задачей раз в interval секунд; одновременные
+    запросы обновления ждут одно общее вычисление
+    """
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self._text = None
+        self._updated_at = None
+        self._refreshing = None
+    
+    @property
+    def age(self):
+        """
+        Возраст снимка в секундах
+        """
+        if self._updated_at is None:
+            return None
+        return time.monotonic() - self._updated_at
+    
+    async def _compute(self):
+        try:
+            self._text = await db.run(_build_stats_text)
+            self._updated_at = time.monotonic()
+            return self._text
+        finally:
+            self._refreshing = None
+    
+    async def refresh(self):
+        """
+        Пересчитывает снимок; если пересчет уже идет, дожидается его
+        """
+        if self._refreshing is None:
+            self._refreshing = asyncio.create_task(self._compute())
+        # shield: отмена одного ожидающего не прерывает общий пересчет
+        return await asyncio.shield(self._refreshing)
+    
+    async def get(self):
+        """
+        Текущий снимок; пересчитывается, только если его еще нет или фоновое обновление отстало
+        """
+        if self._text is None or self.age > self.interval * 2:
+            return await self.refresh()
+        return self._text
+    
+    async def run(self):
+        """
+        Фоновое обновление снимка
+        """
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Ошибка обновления статистики: {e}")
+            await asyncio.sleep(self.interval)
+
+stats_snapshot = StatsSnapshot(STATS_REFRESH_INTERVAL)
+
+def _format_age(seconds):
+    if seconds < 5:
+        return "только что"
+    if seconds < 60:
+        return f"{seconds:.0f} с назад"
+    return f"{seconds // 60:.0f} мин назад"
+
+@lru_cache(maxsize=None)
+def stats_keyboard():
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['refresh']} Обновить", callback_data="admin_stats_refresh"))
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['back']} Назад", callback_data="admin"))
+    return builder.as_markup()
+
+async def show_stats(callback: CallbackQuery, force=False):
+    stats_text = await (stats_snapshot.refresh() if force else stats_snapshot.get())
+    stats_text += f"\n🕒 Обновлено: {_format_age(stats_snapshot.age)}"
+    
+    try:
+        await callback.message.edit_text(stats_text, parse_mode=ParseMode.HTML, reply_markup=stats_keyboard())
+    except TelegramBadRequest:
+        # Снимок не изменился с прошлого показа
+        pass
     await callback.answer()
 
+@dp.callback_query(F.data == "admin_stats")
+async def admin_stats(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+    
+    await show_stats(callback)
+
+@dp.callback_query(F.data == "admin_stats_refresh")
+async def admin_stats_refresh(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+    
+    await show_stats(callback, force=True)
+
 # Рассылка
 @dp.callback_query(F.data == "admin_newsletter")
 async def admin_newsletter(callback: CallbackQuery, state: FSMContext):
@@ -1330,6 +1700,61 @@ async def admin_newsletter(callback: CallbackQuery, state: FSMContext):
     await state.set_state(AdminStates.waiting_for_newsletter)
     await callback.answer()
 
+def _newsletter_progress_text(broadcast, total):
+    return (
+        f"{GREEN_EMOJIS['refresh']} Рассылка: {broadcast.processed} из {total}\n"
+        f"✓ Отправлено: {broadcast.sent}\n"
+        f"✗ Не доставлено: {broadcast.failed}\n"
+        f"⏱ Скорость: {broadcast.throughput:.1f} сообщ/с"
+    )
+
+async def run_newsletter(job):
+    """
+    Фоновая рассылка по сохраненному заданию.
+    Курсор и счетчики периодически сохраняются в БД, после перезапуска
+    рассылка продолжается с последнего подтвержденного пользователя
+    """
+    broadcast = Broadcast(
+        bot,
+        newsletters.stream_user_ids(job['last_user_id']),
+        job['text'],
+        parse_mode=ParseMode.HTML,
+        sent=job['sent'],
+        failed=job['failed'],
+        acknowledged=job['last_user_id'],
+        on_unreachable=mark_unreachable
+    )
+    
+    async def edit_status(text):
+        try:
+            await bot.edit_message_text(text, chat_id=job['admin_chat_id'], message_id=job['status_message_id'])
+        except Exception as e:
+            logger.warning(f"Рассылка {job['id']}: не удалось обновить статус: {e}")
+    
+    async def report(progress):
+        await newsletters.save_progress(job['id'], progress.acknowledged, progress.sent, progress.failed)
+        await edit_status(_newsletter_progress_text(progress, job['total']))
+    
+    try:
+        await broadcast.run(on_progress=report)
+    except Exception as e:
+        logger.error(f"Рассылка {job['id']} прервана: {e}")
+        await newsletters.save_progress(job['id'], broadcast.acknowledged, broadcast.sent, broadcast.failed, 'failed')
+        await edit_status(
+            f"{GREEN_EMOJIS['warning']} Рассылка прервана!\n"
+            f"✓ Отправлено: {broadcast.sent}\n"
+            f"✗ Не доставлено: {broadcast.failed}"
+        )
+        return
+    
+    await newsletters.save_progress(job['id'], broadcast.acknowledged, broadcast.sent, broadcast.failed, 'done')
+    await edit_status(
+        f"{GREEN_EMOJIS['success']} Рассылка завершена!\n"
+        f"✓ Отправлено: {broadcast.sent}\n"
+        f"✗ Не доставлено: {broadcast.failed}\n"
+        f"⏱ Время: {broadcast.elapsed:.0f} с ({broadcast.throughput:.1f} сообщ/с)"
+    )
+
 @dp.message(AdminStates.waiting_for_newsletter)
 async def process_newsletter(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
@@ -1337,32 +1762,16 @@ async def process_newsletter(message: Message, state: FSMContext):
     
     text = message.text
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM users")
-    users = c.fetchall()
-    conn.close()
-    
-    sent = 0
-    failed = 0
-    
-    status_msg = await message.answer(f"{GREEN_EMOJIS['refresh']} Начинаю рассылку {len(users)} пользователям...")
-    
-    for user in users:
-        try:
-            await bot.send_message(user[0], f"{GREEN_EMOJIS['gift']} <b>Рассылка:</b>\n\n{text}", parse_mode=ParseMode.HTML)
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            failed += 1
-            logger.error(f"Ошибка отправки пользователю {user[0]}: {e}")
+    status_msg = await message.answer(f"{GREEN_EMOJIS['refresh']} Начинаю рассылку...")
+    await state.clear()
     
-    await status_msg.edit_text(
-        f"{GREEN_EMOJIS['success']} Рассылка завершена!\n"
-        f"✓ Отправлено: {sent}\n"
-        f"✗ Не доставлено: {failed}"
+    job = await newsletters.create_job(
+        message.chat.id,
+        status_msg.message_id,
+        f"{GREEN_EMOJIS['gift']} <b>Рассылка:</b>\n\n{text}"
     )
-    await state.clear()
+    await status_msg.edit_text(f"{GREEN_EMOJIS['refresh']} Начинаю рассылку {job['total']} пользователям...")
+    start_background_task(run_newsletter(job))
 
 # Изменение цен
 @dp.callback_query(F.data == "admin_prices")
@@ -1371,11 +1780,7 @@ async def admin_prices(callback: CallbackQuery):
         await callback.answer("У вас нет доступа", show_alert=True)
         return
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT id, name, price_rub FROM products WHERE is_active=1")
-    products = c.fetchall()
-    conn.close()
+    products = await db.fetchall("SELECT id, name, price_rub FROM products WHERE is_active=1")
     
     if not products:
         await callback.message.edit_text("Нет активных товаров", reply_markup=back_button("admin"))
@@ -1421,14 +1826,11 @@ async def process_price_change(message: Message, state: FSMContext):
         data = await state.get_data()
         product_id = data['price_product_id']
         
-        conn = sqlite3.connect('dev_monkey.db')
-        c = conn.cursor()
-        c.execute('''UPDATE products 
-                     SET price_rub = ?, price_usdt = ? 
-                     WHERE id = ?''',
-                  (new_price, new_price/USDT_TO_RUB, product_id))
-        conn.commit()
-        conn.close()
+        await db.execute('''UPDATE products 
+                            SET price_rub = ?, price_usdt = ? 
+                            WHERE id = ?''',
+                         (new_price, new_price/USDT_TO_RUB, product_id))
+        catalog.invalidate()
         
         await message.answer(f"{GREEN_EMOJIS['success']} Цена успешно изменена!")
         await state.clear()
@@ -1436,6 +1838,73 @@ async def process_price_change(message: Message, state: FSMContext):
     except ValueError:
         await message.answer(f"{GREEN_EMOJIS['warning']} Введите корректное число")
 
+# Пороги уведомлений об остатках
+@dp.callback_query(F.data == "admin_stock_thresholds")
+async def admin_stock_thresholds(callback: CallbackQuery):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+    
+    products = await catalog.active()
+    
+    if not products:
+        await callback.message.edit_text("Нет активных товаров", reply_markup=back_button("admin"))
+        await callback.answer()
+        return
+    
+    stock = await get_stock_levels()
+    builder = InlineKeyboardBuilder()
+    for product in products:
+        threshold = product[11] if product[11] is not None else LOW_STOCK_THRESHOLD
+        builder.row(InlineKeyboardButton(
+            text=f"{product[1]} - {stock.get(product[0], 0)} шт. (порог {threshold})",
+            callback_data=f"edit_threshold_{product[0]}"
+        ))
+    builder.row(InlineKeyboardButton(text=f"{GREEN_EMOJIS['back']} Назад", callback_data="admin"))
+    
+    await callback.message.edit_text(
+        f"{GREEN_EMOJIS['warning']} Уведомление приходит, когда остаток товара опускается до порога.\n"
+        f"Выберите товар для изменения порога:",
+        reply_markup=builder.as_markup()
+    )
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("edit_threshold_"))
+async def edit_threshold(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+    
+    product_id = int(callback.data.split("_")[2])
+    await state.update_data(threshold_product_id=product_id)
+    
+    await callback.message.edit_text(
+        f"{GREEN_EMOJIS['warning']} Введите порог остатка (0 - уведомлять только когда товар закончится):"
+    )
+    await state.set_state(AdminStates.waiting_for_stock_threshold)
+    await callback.answer()
+
+@dp.message(AdminStates.waiting_for_stock_threshold)
+async def process_stock_threshold(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    
+    try:
+        threshold = int(message.text)
+        if threshold < 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        await message.answer(f"{GREEN_EMOJIS['warning']} Введите целое число не меньше 0")
+        return
+    
+    data = await state.get_data()
+    product_id = data['threshold_product_id']
+    await db.execute("UPDATE products SET low_stock_threshold = ? WHERE id = ?", (threshold, product_id))
+    catalog.invalidate()
+    
+    await message.answer(f"{GREEN_EMOJIS['success']} Порог остатка изменен!")
+    await state.clear()
+
 # Добавление товара
 @dp.callback_query(F.data == "admin_add_product")
 async def admin_add_product(callback: CallbackQuery, state: FSMContext):
@@ -1498,17 +1967,13 @@ async def process_product_limit(message: Message, state: FSMContext):
         else:
             instruction_url = f"{INSTRUCTION_SITE}/#vpn"
         
-        conn = sqlite3.connect('dev_monkey.db')
-        c = conn.cursor()
-        c.execute('''INSERT INTO products 
-                     (name, type, price_rub, price_usdt, limit_users, instruction, instruction_url, is_active)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (data['product_name'], data['product_type'], 
-                   data['price_rub'], data['price_usdt'], limit, 
-                   "Инструкция будет добавлена позже", instruction_url, 1))
-        product_id = c.lastrowid
-        conn.commit()
-        conn.close()
+        product_id = await db.execute('''INSERT INTO products 
+                                         (name, type, price_rub, price_usdt, limit_users, instruction, instruction_url, is_active)
+                                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                      (data['product_name'], data['product_type'], 
+                                       data['price_rub'], data['price_usdt'], limit, 
+                                       "Инструкция будет добавлена позже", instruction_url, 1))
+        catalog.invalidate()
         
         await message.answer(
             f"{GREEN_EMOJIS['success']} Товар успешно добавлен! (ID: {product_id})\n\n"
@@ -1528,11 +1993,7 @@ async def admin_add_data(callback: CallbackQuery, state: FSMContext):
         await callback.answer("У вас нет доступа", show_alert=True)
         return
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT id, name, type FROM products WHERE is_active=1")
-    products = c.fetchall()
-    conn.close()
+    products = await db.fetchall("SELECT id, name, type FROM products WHERE is_active=1")
     
     if not products:
         await callback.message.edit_text("Нет активных товаров", reply_markup=back_button("admin"))
@@ -1562,32 +2023,131 @@ async def add_data_to_product(callback: CallbackQuery, state: FSMContext):
     
     product_id = int(callback.data.split("_")[2])
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT type, name FROM products WHERE id = ?", (product_id,))
-    result = c.fetchone()
-    conn.close()
+    product = await catalog.get(product_id)
     
-    if not result:
+    if not product:
         await callback.answer("Товар не найден")
         return
     
-    product_type, product_name = result
+    product_type, product_name = product[2], product[1]
     await state.update_data(product_id=product_id, product_type=product_type)
     
-    type_text = "прокси" if product_type == "proxy" else "VPN"
+    is_proxy = 'proxy' in product_type
+    type_text = "прокси" if is_proxy else "VPN"
     
     await callback.message.edit_text(
         f"{GREEN_EMOJIS['leaf']} Добавление данных для товара: {product_name}\n\n"
-        f"Введите данные (каждую новую позицию с новой строки):\n\n"
+        f"Введите данные (каждую новую позицию с новой строки)\n"
+        f"или отправьте файл .txt / .csv:\n\n"
         f"Для {type_text} формат:\n"
-        f"{'ip:port:login:password' if product_type == 'proxy' else 'сервер или ключ'}\n\n"
+        f"{'ip:port:login:password' if is_proxy else 'сервер или ключ'}\n\n"
         f"Пример:\n"
-        f"{'192.168.1.1:8080:user:pass' if product_type == 'proxy' else 'vpn-server.com'}"
+        f"{'192.168.1.1:8080:user:pass' if is_proxy else 'vpn-server.com'}"
     )
     await state.set_state(AdminStates.waiting_for_product_data)
     await callback.answer()
 
+def _insert_item_chunk(conn, product_id, kind, items):
+    """
+    Добавляет пачку позиций; дубли по хэшу данных пропускаются уникальным индексом.
+    Возвращает количество добавленных
+    """
+    table, column = ITEM_TABLES[kind]
+    added = conn.executemany(f"INSERT OR IGNORE INTO {table} (product_id, {column}, content_hash) VALUES (?, ?, ?)",
+                             [(product_id, item, content_hash(item)) for item in items]).rowcount
+    # Счетчик наличия меняется в той же транзакции
+    conn.execute('''INSERT INTO product_stock (product_id, available) VALUES (?, ?)
+                    ON CONFLICT(product_id) DO UPDATE SET available = available + excluded.available''',
+                 (product_id, added))
+    return added
+
+def _decode_line(raw):
+    try:
+        return raw.decode('utf-8-sig').rstrip('\r')
+    except UnicodeDecodeError:
+        return None
+
+async def _text_lines(text):
+    for line in text.split('\n'):
+        yield line
+
+async def _document_lines(document):
+    """
+    Читает документ из Telegram построчно по мере загрузки, не держа файл в памяти.
+    Строки не в UTF-8 отдаются как None
+    """
+    file = await bot.get_file(document.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    buffer = b''
+    async for chunk in bot.session.stream_content(url, timeout=IMPORT_DOWNLOAD_TIMEOUT):
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for raw in lines:
+            yield _decode_line(raw)
+    if buffer:
+        yield _decode_line(buffer)
+
+def _is_valid_proxy(line):
+    # Формат ip:port или ip:port:login:password
+    parts = line.split(':')
+    if len(parts) not in (2, 4) or not all(parts) or any(ch.isspace() for ch in line):
+        return False
+    port = parts[1]
+    return port.isascii() and port.isdigit() and 1 <= int(port) <= 65535
+
+def _csv_item(line, kind):
+    # Прокси в CSV - колонки ip, port, login, password; VPN - первая колонка
+    fields = [field.strip() for field in next(csv.reader([line]), [])]
+    if kind == 'proxy':
+        return ':'.join(field for field in fields if field)
+    return fields[0] if fields else ''
+
+async def import_product_items(product_id, product_type, lines, is_csv=False):
+    """
+    Добавляет позиции товара из асинхронного потока строк.
+    Пустые строки и комментарии (#) пропускаются, некорректные строки
+    (не UTF-8, слишком длинные, прокси не в формате ip:port[:login:password])
+    отбрасываются.
+    Позиции пишутся пачками по IMPORT_CHUNK_SIZE, каждая пачка - своя транзакция;
+    уже имеющиеся у товара данные не добавляются повторно.
+    Возвращает отчет: added, duplicates, skipped, malformed, total_available
+    """
+    kind = 'proxy' if 'proxy' in product_type else 'vpn'
+    report = {'added': 0, 'duplicates': 0, 'skipped': 0, 'malformed': 0}
+    chunk = []
+    
+    async for line in lines:
+        if line is None:
+            report['malformed'] += 1
+            continue
+        line = line.strip()
+        if not line or line.startswith('#'):
+            report['skipped'] += 1
+            continue
+        if is_csv:
+            line = _csv_item(line, kind)
+        if not line or len(line) > IMPORT_MAX_LINE_LENGTH or (kind == 'proxy' and not _is_valid_proxy(line)):
+            report['malformed'] += 1
+            continue
+        
+        chunk.append(line)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            added = await db.transaction(_insert_item_chunk, product_id, kind, chunk)
+            report['added'] += added
+            report['duplicates'] += len(chunk) - added
+            chunk = []
+    
+    if chunk:
+        added = await db.transaction(_insert_item_chunk, product_id, kind, chunk)
+        report['added'] += added
+        report['duplicates'] += len(chunk) - added
+    
+    row = await db.fetchone("SELECT available, MAX(available - reserved, 0) FROM product_stock WHERE product_id = ?",
+                            (product_id,))
+    report['total_available'] = row[0] if row else 0
+    stock_alerts.observe(product_id, row[1] if row else 0)
+    return report
+
 @dp.message(AdminStates.waiting_for_product_data)
 async def process_product_data(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
@@ -1597,54 +2157,51 @@ async def process_product_data(message: Message, state: FSMContext):
     product_id = data['product_id']
     product_type = data['product_type']
     
-    lines = message.text.strip().split('\n')
-    added = 0
-    errors = 0
-    
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    
-    # Начинаем транзакцию
-    c.execute("BEGIN TRANSACTION")
+    document = message.document
+    if document:
+        file_name = (document.file_name or '').lower()
+        if not file_name.endswith(('.txt', '.csv')):
+            await message.answer(f"{GREEN_EMOJIS['warning']} Поддерживаются только файлы .txt и .csv")
+            return
+        if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+            await message.answer(f"{GREEN_EMOJIS['warning']} Файл больше 20 МБ, разделите его на части")
+            return
+        lines = _document_lines(document)
+        is_csv = file_name.endswith('.csv')
+        await message.answer(f"{GREEN_EMOJIS['refresh']} Загружаю файл {document.file_name}...")
+    elif message.text:
+        lines = _text_lines(message.text)
+        is_csv = False
+    else:
+        await message.answer(f"{GREEN_EMOJIS['warning']} Отправьте данные текстом или файлом .txt / .csv")
+        return
     
+    report = None
     try:
-        for line in lines:
-            line = line.strip()
-            if line:
-                if product_type == 'proxy':
-                    c.execute('''INSERT INTO proxy_items (product_id, proxy_data) 
-                                 VALUES (?, ?)''', (product_id, line))
-                else:
-                    c.execute('''INSERT INTO vpn_items (product_id, vpn_data) 
-                                 VALUES (?, ?)''', (product_id, line))
-                added += 1
-        
-        # Подтверждаем транзакцию
-        conn.commit()
-        
-        # Проверяем общее количество после добавления
-        if product_type == 'proxy':
-            c.execute("SELECT COUNT(*) FROM proxy_items WHERE product_id = ? AND is_available = 1", (product_id,))
-        else:
-            c.execute("SELECT COUNT(*) FROM vpn_items WHERE product_id = ? AND is_available = 1", (product_id,))
-        total_available = c.fetchone()[0]
-        
-        logger.info(f"Добавлено {added} позиций для товара {product_id}. Всего доступно: {total_available}")
-        
+        report = await import_product_items(product_id, product_type, lines, is_csv)
+        logger.info(f"Добавлено {report['added']} позиций для товара {product_id}. "
+                    f"Всего доступно: {report['total_available']}")
     except Exception as e:
-        conn.rollback()
-        errors = 1
         logger.error(f"Ошибка при добавлении данных: {e}")
     
-    conn.close()
-    
     # Отправляем результат
-    if added > 0:
+    if report and report['added'] > 0:
         await message.answer(
             f"{GREEN_EMOJIS['success']} <b>Данные успешно добавлены!</b>\n\n"
-            f"✅ Добавлено: {added} позиций\n"
+            f"✅ Добавлено: {report['added']} позиций\n"
+            f"♻️ Дублей отброшено: {report['duplicates']}\n"
+            f"⏭ Пропущено пустых строк: {report['skipped']}\n"
+            f"✗ Некорректных строк: {report['malformed']}\n"
             f"📦 Теперь товар доступен для покупки!\n"
-            f"📊 Всего в наличии: {total_available} шт",
+            f"📊 Всего в наличии: {report['total_available']} шт",
+            parse_mode=ParseMode.HTML
+        )
+    elif report:
+        await message.answer(
+            f"{GREEN_EMOJIS['warning']} Не удалось добавить данные. Проверьте формат и попробуйте снова.\n"
+            f"♻️ Дублей отброшено: {report['duplicates']}\n"
+            f"⏭ Пропущено пустых строк: {report['skipped']}\n"
+            f"✗ Некорректных строк: {report['malformed']}",
             parse_mode=ParseMode.HTML
         )
     else:
@@ -1662,11 +2219,7 @@ async def admin_instructions(callback: CallbackQuery, state: FSMContext):
         await callback.answer("У вас нет доступа", show_alert=True)
         return
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT id, name, instruction, instruction_url FROM products")
-    products = c.fetchall()
-    conn.close()
+    products = await db.fetchall("SELECT id, name, instruction, instruction_url FROM products")
     
     if not products:
         await callback.message.edit_text("Нет товаров", reply_markup=back_button("admin"))
@@ -1716,12 +2269,9 @@ async def process_instruction(message: Message, state: FSMContext):
     instruction_text = parts[0].strip()
     instruction_url = parts[1].strip() if len(parts) > 1 else f"{INSTRUCTION_SITE}/#proxy"
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("UPDATE products SET instruction = ?, instruction_url = ? WHERE id = ?", 
-              (instruction_text, instruction_url, product_id))
-    conn.commit()
-    conn.close()
+    await db.execute("UPDATE products SET instruction = ?, instruction_url = ? WHERE id = ?", 
+                     (instruction_text, instruction_url, product_id))
+    catalog.invalidate()
     
     await message.answer(f"{GREEN_EMOJIS['success']} Инструкция обновлена!")
     await state.clear()
@@ -1778,13 +2328,9 @@ async def process_free_instruction(message: Message, state: FSMContext):
     
     data = await state.get_data()
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO free_keys (type, key, instruction) 
-                 VALUES (?, ?, ?)''',
-              (data['free_type'], data['free_key'], message.text))
-    conn.commit()
-    conn.close()
+    await db.execute('''INSERT INTO free_keys (type, key, instruction) 
+                        VALUES (?, ?, ?)''',
+                     (data['free_type'], data['free_key'], message.text))
     
     await message.answer(f"{GREEN_EMOJIS['success']} Бесплатный ключ добавлен!")
     await state.clear()
@@ -1795,12 +2341,8 @@ async def list_free_keys(callback: CallbackQuery):
         await callback.answer("У вас нет доступа", show_alert=True)
         return
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute('''SELECT id, type, key, is_available, used_by, used_date 
-                 FROM free_keys ORDER BY id DESC''')
-    keys = c.fetchall()
-    conn.close()
+    keys = await db.fetchall('''SELECT id, type, key, is_available, used_by, used_date 
+                                FROM free_keys ORDER BY id DESC''')
     
     if not keys:
         await callback.message.edit_text("Нет бесплатных ключей", reply_markup=back_button("admin_free_keys"))
@@ -1836,11 +2378,7 @@ async def admin_manage_products(callback: CallbackQuery):
         await callback.answer("У вас нет доступа", show_alert=True)
         return
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT id, name, price_rub, current_users, limit_users, is_active FROM products")
-    products = c.fetchall()
-    conn.close()
+    products = await db.fetchall("SELECT id, name, price_rub, current_users, limit_users, is_active FROM products")
     
     if not products:
         await callback.message.edit_text("Нет товаров", reply_markup=back_button("admin"))
@@ -1870,15 +2408,11 @@ async def toggle_product(callback: CallbackQuery):
     
     product_id = int(callback.data.split("_")[2])
     
-    conn = sqlite3.connect('dev_monkey.db')
-    c = conn.cursor()
-    c.execute("SELECT is_active FROM products WHERE id = ?", (product_id,))
-    current = c.fetchone()[0]
+    current = (await catalog.get(product_id))[10]
     
     new_status = 0 if current == 1 else 1
-    c.execute("UPDATE products SET is_active = ? WHERE id = ?", (new_status, product_id))
-    conn.commit()
-    conn.close()
+    await db.execute("UPDATE products SET is_active = ? WHERE id = ?", (new_status, product_id))
+    catalog.invalidate()
     
     await callback.answer(f"Товар {'включен' if new_status == 1 else 'отключен'}")
     
@@ -1938,15 +2472,47 @@ async def handle_unknown(message: Message):
 
 async def main():
     # Инициализация БД
-    init_db()
-    add_admin()
-    add_initial_products()
+    await init_db()
+    await add_admin()
+    await add_initial_products()
+    await warm_up()
+    
+    # Восстанавливаем открытые счета после перезапуска
+    restored = await payments.load()
+    if restored:
+        logger.info(f"Восстановлено открытых счетов: {restored}")
+    
+    # Продолжаем рассылки, прерванные перезапуском
+    for job in await newsletters.load_unfinished():
+        logger.info(f"Продолжаю рассылку {job['id']} после пользователя {job['last_user_id']}")
+        start_background_task(run_newsletter(job))
     
     # Запускаем фоновую проверку платежей
     asyncio.create_task(payment_checker())
     
+    # Отправка сообщений из очереди
+    start_background_task(outbox_dispatcher.run())
+    
+    # Фоновое обновление статистики админа
+    start_background_task(stats_snapshot.run())
+    
+    # Проверка прокси, нерабочие снимаются с продажи
+    start_background_task(proxy_checker.run())
+    
+    # Webhook для мгновенного подтверждения оплаты
+    webhook_runner = None
+    if CRYPTO_WEBHOOK_PORT:
+        webhook_app = create_webhook_app(CRYPTO_BOT_TOKEN, handle_invoice_paid, CRYPTO_WEBHOOK_PATH)
+        webhook_runner = await start_webhook_server(webhook_app, CRYPTO_WEBHOOK_HOST, CRYPTO_WEBHOOK_PORT)
+    
     logger.info("Бот Dev Monkey запущен")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        await crypto_client.close()
+        await db.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,81 @@
+import logging
+from datetime import datetime
+
+from database import DATE_FORMAT, db
+
+logger = logging.getLogger(__name__)
+
+# Сколько получателей читать из БД за один запрос
+RECIPIENTS_PAGE_SIZE = 500
+
+JOB_COLUMNS = "id, admin_chat_id, status_message_id, text, last_user_id, total, sent, failed"
+
+
+def _row_to_job(row):
+    return {
+        'id': row[0],
+        'admin_chat_id': row[1],
+        'status_message_id': row[2],
+        'text': row[3],
+        'last_user_id': row[4],
+        'total': row[5],
+        'sent': row[6],
+        'failed': row[7],
+    }
+
+
+async def create_job(admin_chat_id, status_message_id, text):
+    """
+    Сохраняет новую рассылку и возвращает ее
+    """
+    total = (await db.fetchone("SELECT COUNT(*) FROM users WHERE is_blocked = 0"))[0]
+    now = datetime.now().strftime(DATE_FORMAT)
+    job_id = await db.execute('''INSERT INTO newsletter_jobs
+                                 (admin_chat_id, status_message_id, text, status, total, created_at, updated_at)
+                                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                              (admin_chat_id, status_message_id, text, 'running', total, now, now))
+    return {
+        'id': job_id,
+        'admin_chat_id': admin_chat_id,
+        'status_message_id': status_message_id,
+        'text': text,
+        'last_user_id': 0,
+        'total': total,
+        'sent': 0,
+        'failed': 0,
+    }
+
+
+async def load_unfinished():
+    """
+    Рассылки, прерванные перезапуском
+    """
+    rows = await db.fetchall(f"SELECT {JOB_COLUMNS} FROM newsletter_jobs WHERE status = 'running' ORDER BY id")
+    return [_row_to_job(row) for row in rows]
+
+
+async def save_progress(job_id, last_user_id, sent, failed, status='running'):
+    """
+    Сохраняет курсор рассылки: все пользователи до last_user_id включительно обработаны
+    """
+    await db.execute('''UPDATE newsletter_jobs
+                        SET last_user_id = ?, sent = ?, failed = ?, status = ?, updated_at = ?
+                        WHERE id = ?''',
+                     (last_user_id, sent, failed, status, datetime.now().strftime(DATE_FORMAT), job_id))
+
+
+async def stream_user_ids(after_user_id=0, page_size=RECIPIENTS_PAGE_SIZE):
+    """
+    Отдает user_id доступных пользователей по возрастанию после after_user_id,
+    читая БД страницами по ключу.
+    В памяти одновременно находится не больше одной страницы
+    """
+    while True:
+        rows = await db.fetchall("SELECT user_id FROM users WHERE user_id > ? AND is_blocked = 0 "
+                                 "ORDER BY user_id LIMIT ?",
+                                 (after_user_id, page_size))
+        for row in rows:
+            yield row[0]
+        if len(rows) < page_size:
+            return
+        after_user_id = rows[-1][0]
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+from backoff import full_jitter
+from broadcast import is_unreachable, telegram_limiter
+from database import DATE_FORMAT, db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 5
+DEFAULT_MAX_ATTEMPTS = 8
+# Сколько сообщений забирать из очереди за раз
+BATCH_SIZE = 50
+BACKOFF_BASE = 2
+BACKOFF_MAX = 600
+# Максимальная пауза между проверками очереди, если диспетчер не разбудили
+IDLE_WAIT = 30
+
+
+def _is_permanent(error):
+    # Повтор не исправит разметку, которую Telegram не смог разобрать
+    return isinstance(error, TelegramBadRequest) and "can't parse entities" in str(error).lower()
+
+
+def enqueue(conn, chat_id, text, parse_mode=None, reply_markup=None):
+    """
+    Ставит сообщение в очередь на отправку.
+    Вызывается в транзакции изменения, о котором сообщение: оно сохраняется
+    только вместе с закоммиченным изменением
+    """
+    markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+    conn.execute('''INSERT INTO outbox
+                    (chat_id, text, parse_mode, reply_markup, status, next_attempt_at, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                 (chat_id, text, parse_mode, markup, 'pending', time.time(),
+                  datetime.now().strftime(DATE_FORMAT)))
+
+
+def _fetch_due(conn, now, limit):
+    return conn.execute('''SELECT id, chat_id, text, parse_mode, reply_markup, attempts
+                           FROM outbox
+                           WHERE status = 'pending' AND next_attempt_at <= ?
+                           ORDER BY next_attempt_at
+                           LIMIT ?''', (now, limit)).fetchall()
+
+
+def _next_attempt_at(conn):
+    return conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+
+class OutboxDispatcher:
+    """
+    Фоновая отправка сообщений из таблицы outbox.
+    Отправляет не больше concurrency сообщений одновременно через общий лимитер бота,
+    временные ошибки повторяет с экспоненциальной задержкой и джиттером.
+    Недоступные получатели и исчерпанные попытки помечаются failed, о них
+    сообщает await on_failed(chat_id, text, error)
+    """
+
+    def __init__(self, bot, concurrency=DEFAULT_CONCURRENCY, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 limiter=None, on_unreachable=None, on_failed=None):
+        self.bot = bot
+        self.max_attempts = max_attempts
+        self.limiter = limiter or telegram_limiter
+        self.on_unreachable = on_unreachable
+        self.on_failed = on_failed
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        """
+        Будит диспетчер после коммита новых сообщений
+        """
+        self._wakeup.set()
+
+    async def _send(self, row):
+        message_id, chat_id, text, parse_mode, markup, attempts = row
+        async with self._semaphore:
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.send_message(
+                    chat_id, text, parse_mode=parse_mode,
+                    reply_markup=InlineKeyboardMarkup.model_validate_json(markup) if markup else None
+                )
+            except TelegramRetryAfter as e:
+                self.limiter.pause(e.retry_after)
+                await db.execute("UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                                 (time.time() + e.retry_after, message_id))
+                return
+            except Exception as e:
+                await self._fail(row, e)
+                return
+
+        await db.execute("UPDATE outbox SET status = ?, attempts = ?, sent_at = ? WHERE id = ?",
+                         ('sent', attempts + 1, datetime.now().strftime(DATE_FORMAT), message_id))
+
+    async def _fail(self, row, error):
+        message_id, chat_id, text, _, _, attempts = row
+        attempts += 1
+        unreachable = is_unreachable(error)
+
+        if unreachable or _is_permanent(error) or attempts >= self.max_attempts:
+            await db.execute("UPDATE outbox SET status = ?, attempts = ?, last_error = ? WHERE id = ?",
+                             ('failed', attempts, str(error), message_id))
+            logger.error(f"Сообщение {message_id} для {chat_id} не доставлено: {error}")
+            if unreachable and self.on_unreachable:
+                await self.on_unreachable(chat_id)
+            if self.on_failed:
+                await self.on_failed(chat_id, text, error)
+            return
+
+        delay = full_jitter(attempts, BACKOFF_BASE, BACKOFF_MAX)
+        logger.warning(f"Сообщение {message_id} для {chat_id}: {error!r}, попытка {attempts}")
+        await db.execute("UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                         (attempts, time.time() + delay, str(error), message_id))
+
+    async def run(self):
+        """
+        Разбирает очередь, пока бот работает
+        """
+        while True:
+            try:
+                # Сбрасываем до чтения очереди, чтобы не потерять wake() во время запроса
+                self._wakeup.clear()
+                rows = await db.run(_fetch_due, time.time(), BATCH_SIZE)
+                if rows:
+                    await asyncio.gather(*(self._send(row) for row in rows))
+                    continue
+
+                next_attempt_at = await db.run(_next_attempt_at)
+                timeout = IDLE_WAIT
+                if next_attempt_at is not None:
+                    timeout = max(0, min(IDLE_WAIT, next_attempt_at - time.time()))
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                logger.error(f"Ошибка в диспетчере сообщений: {e}")
+                await asyncio.sleep(IDLE_WAIT)
@@ -0,0 +1,320 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from database import DATE_FORMAT, db
+
+logger = logging.getLogger(__name__)
+
+# Сколько держать завершенные платежи в памяти (секунды)
+FINISHED_PAYMENT_TTL = 3600
+
+# Частота проверки счета в зависимости от возраста: (возраст до, сек; интервал, сек).
+# Сразу после создания счет проверяется часто, затем все реже
+DEFAULT_CHECK_SCHEDULE = ((120, 5), (600, 15), (float('inf'), 60))
+
+# Типы событий в очереди сроков
+EXPIRE = 'expire'
+CHECK = 'check'
+
+PAYMENT_COLUMNS = "invoice_id, user_id, product_id, amount_rub, status, pay_url, created_at, expires_at, reserved"
+
+
+def _ceil_to_second(value):
+    # В БД время хранится с точностью до секунды; округляем вверх,
+    # чтобы счет не истекал раньше, чем в Crypto Pay
+    if value.microsecond:
+        value = value.replace(microsecond=0) + timedelta(seconds=1)
+    return value
+
+
+def update_payment_status(conn, invoice_id, status):
+    """
+    Переводит платеж в конечный статус в БД; может выполняться внутри транзакции
+    вместе с проведением покупки. Возвращает 0, если платеж в БД уже завершен
+    """
+    return conn.execute('''UPDATE payments SET status = ?, updated_at = ?
+                           WHERE invoice_id = ? AND status = ?''',
+                        (status, datetime.now().strftime(DATE_FORMAT), invoice_id, 'pending')).rowcount
+
+
+def reserve_item(conn, product_id):
+    """
+    Резервирует единицу товара под новый счет.
+    Возвращает новый остаток в продаже или None, если все свободные единицы
+    уже зарезервированы
+    """
+    row = conn.execute('''UPDATE product_stock SET reserved = reserved + 1
+                          WHERE product_id = ? AND available - reserved > 0
+                          RETURNING available - reserved''', (product_id,)).fetchone()
+    return row[0] if row else None
+
+
+def release_item(conn, product_id):
+    """
+    Снимает резерв единицы товара: счет истек, отменен или не был создан.
+    Возвращает новый остаток в продаже или None, если товара нет в product_stock
+    """
+    row = conn.execute('''UPDATE product_stock SET reserved = MAX(reserved - 1, 0)
+                          WHERE product_id = ?
+                          RETURNING MAX(available - reserved, 0)''', (product_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _close_payment(conn, payment, status):
+    # Резерв снимает только тот, кто перевел платеж в конечный статус
+    if update_payment_status(conn, payment['invoice_id'], status) and payment['reserved']:
+        return release_item(conn, payment['product_id'])
+    return None
+
+
+def _restore_reservations(conn):
+    # Резерв мог разойтись с открытыми счетами, если бот упал между резервированием и созданием счета
+    conn.execute('''UPDATE product_stock SET reserved = (
+                        SELECT COUNT(*) FROM payments p
+                        WHERE p.product_id = product_stock.product_id
+                          AND p.status = 'pending' AND p.reserved = 1
+                    )''')
+
+
+def _row_to_payment(row):
+    return {
+        'invoice_id': row[0],
+        'user_id': row[1],
+        'product_id': row[2],
+        'amount_rub': row[3],
+        'status': row[4],
+        'pay_url': row[5],
+        'created_at': datetime.strptime(row[6], DATE_FORMAT),
+        'expires_at': datetime.strptime(row[7], DATE_FORMAT),
+        'reserved': row[8],
+    }
+
+
+class PaymentStore:
+    """
+    Хранилище платежей с ключом по invoice_id.
+    Все платежи пишутся в таблицу payments, в памяти держится индекс открытых
+    счетов и недавно завершенные платежи (вытесняются по TTL).
+    Открытые счета стоят в куче сроков: истечение срабатывает ровно в expires_at,
+    проверки статуса - по расписанию check_schedule.
+    Когда снятие резерва меняет остаток в продаже, вызывается
+    on_stock_change(product_id, остаток)
+    """
+
+    def __init__(self, finished_ttl=FINISHED_PAYMENT_TTL, check_schedule=DEFAULT_CHECK_SCHEDULE,
+                 on_stock_change=None):
+        self.finished_ttl = finished_ttl
+        self.check_schedule = check_schedule
+        self.on_stock_change = on_stock_change
+        self._open = {}
+        self._finished = {}
+        self._eviction_queue = deque()
+        self._deadlines = []
+        # (invoice_id, тип) -> номер действующей записи в куче; остальные записи устарели
+        self._current = {}
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    async def load(self):
+        """
+        Восстанавливает открытые счета и резервы товара из БД после перезапуска
+        """
+        await db.transaction(_restore_reservations)
+        rows = await db.fetchall(f"SELECT {PAYMENT_COLUMNS} FROM payments WHERE status = 'pending'")
+        for row in rows:
+            payment = _row_to_payment(row)
+            self._open[payment['invoice_id']] = payment
+            self._schedule(payment)
+        return len(rows)
+
+    async def create(self, invoice_id, user_id, product_id, amount_rub, pay_url, expires_at, reserved=False):
+        """
+        Сохраняет новый счет. reserved - под счет уже взят резерв через reserve_item()
+        """
+        payment = {
+            'invoice_id': invoice_id,
+            'user_id': user_id,
+            'product_id': product_id,
+            'amount_rub': amount_rub,
+            'status': 'pending',
+            'pay_url': pay_url,
+            'created_at': datetime.now().replace(microsecond=0),
+            'expires_at': _ceil_to_second(expires_at),
+            'reserved': int(reserved),
+        }
+        await db.execute(f'''INSERT INTO payments ({PAYMENT_COLUMNS})
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (invoice_id, user_id, product_id, amount_rub, 'pending', pay_url,
+                          payment['created_at'].strftime(DATE_FORMAT),
+                          payment['expires_at'].strftime(DATE_FORMAT),
+                          payment['reserved']))
+        self._open[invoice_id] = payment
+        self._schedule(payment)
+        return payment
+
+    def get(self, invoice_id):
+        """
+        Платеж из памяти: открытый или недавно завершенный
+        """
+        return self._open.get(invoice_id) or self._finished.get(invoice_id)
+
+    def find_open(self, user_id, product_id):
+        """
+        Открытый счет пользователя на товар с резервом, если он еще не истек
+        """
+        now = datetime.now()
+        for payment in self._open.values():
+            if (payment['user_id'] == user_id and payment['product_id'] == product_id
+                    and payment['reserved'] and payment['expires_at'] > now):
+                return payment
+        return None
+
+    async def find(self, invoice_id):
+        """
+        Платеж из памяти, а если его там уже нет - из БД
+        """
+        payment = self.get(invoice_id)
+        if payment:
+            return payment
+        row = await db.fetchone(f"SELECT {PAYMENT_COLUMNS} FROM payments WHERE invoice_id = ?", (invoice_id,))
+        return _row_to_payment(row) if row else None
+
+    def mark_finished(self, payment, status):
+        """
+        Переводит открытый платеж в конечный статус только в памяти.
+        Возвращает False, если платеж уже завершен: переход синхронный,
+        поэтому из нескольких конкурирующих обработчиков проходит один.
+        Статус в БД записывает update_payment_status()
+        """
+        if payment['status'] != 'pending':
+            return False
+
+        payment['status'] = status
+        invoice_id = payment['invoice_id']
+        self._open.pop(invoice_id, None)
+        self._current.pop((invoice_id, EXPIRE), None)
+        self._current.pop((invoice_id, CHECK), None)
+        self._finished[invoice_id] = payment
+        self._eviction_queue.append((time.monotonic() + self.finished_ttl, invoice_id))
+        return True
+
+    async def finish(self, payment, status):
+        """
+        Переводит открытый платеж в конечный статус (expired, cancelled)
+        в памяти и в БД и снимает резерв товара. Возвращает False, если платеж уже завершен.
+        Оплаченный счет проводится через mark_finished() и update_payment_status(),
+        резерв тогда расходуется при выдаче товара
+        """
+        if not self.mark_finished(payment, status):
+            return False
+        try:
+            available = await db.transaction(_close_payment, payment, status)
+        except Exception:
+            # В БД платеж остался pending: возвращаем его в открытые, иначе резерв
+            # продолжит висеть до перезапуска
+            self.reopen(payment)
+            raise
+        if available is not None and self.on_stock_change:
+            self.on_stock_change(payment['product_id'], available)
+        return True
+
+    def reopen(self, payment):
+        """
+        Возвращает платеж в открытые, если его не удалось провести в БД
+        """
+        invoice_id = payment['invoice_id']
+        payment['status'] = 'pending'
+        self._finished.pop(invoice_id, None)
+        # Старая запись вытеснения иначе выкинула бы платеж раньше срока,
+        # когда он завершится снова. Путь редкий, поэтому просто пересобираем очередь
+        self._eviction_queue = deque(entry for entry in self._eviction_queue if entry[1] != invoice_id)
+        self._open[invoice_id] = payment
+        self._schedule(payment)
+
+    def postpone_expire(self, payment, delay):
+        """
+        Переносит истечение открытого счета на delay секунд,
+        если его статус в Crypto Pay не удалось узнать
+        """
+        if payment['invoice_id'] in self._open:
+            self._push(time.time() + delay, EXPIRE, payment['invoice_id'])
+
+    def evict_finished(self):
+        """
+        Убирает из памяти завершенные платежи старше TTL
+        """
+        now = time.monotonic()
+        evicted = 0
+        while self._eviction_queue and self._eviction_queue[0][0] <= now:
+            _, invoice_id = self._eviction_queue.popleft()
+            if self._finished.pop(invoice_id, None) is not None:
+                evicted += 1
+        return evicted
+
+    # ============= ОЧЕРЕДЬ СРОКОВ =============
+
+    def _check_interval(self, payment, now):
+        age = now - payment['created_at'].timestamp()
+        for max_age, interval in self.check_schedule:
+            if age < max_age:
+                return interval
+        return self.check_schedule[-1][1]
+
+    def _push(self, when, kind, invoice_id):
+        if not self._deadlines or when < self._deadlines[0][0]:
+            # Новый ближайший срок - будим ожидающий wait_due()
+            self._wakeup.set()
+        # Новая запись заменяет прежнюю того же типа: старая отбросится в pop_due()
+        sequence = next(self._sequence)
+        self._current[(invoice_id, kind)] = sequence
+        heapq.heappush(self._deadlines, (when, sequence, kind, invoice_id))
+
+    def _schedule(self, payment):
+        now = time.time()
+        self._push(payment['expires_at'].timestamp(), EXPIRE, payment['invoice_id'])
+        self._push(now + self._check_interval(payment, now), CHECK, payment['invoice_id'])
+
+    def pop_due(self, now=None):
+        """
+        Забирает наступившие сроки: (истекшие счета, счета для проверки).
+        Записи завершенных платежей и замененные записи отбрасываются лениво, стоимость зависит
+        только от числа наступивших сроков
+        """
+        now = now or time.time()
+        expired = {}
+        to_check = {}
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, sequence, kind, invoice_id = heapq.heappop(self._deadlines)
+            if self._current.get((invoice_id, kind)) != sequence:
+                continue
+            payment = self._open.get(invoice_id)
+            if payment is None:
+                continue
+            if kind == EXPIRE:
+                del self._current[(invoice_id, EXPIRE)]
+                expired[invoice_id] = payment
+            else:
+                to_check[invoice_id] = payment
+                self._push(now + self._check_interval(payment, now), CHECK, invoice_id)
+
+        for invoice_id in expired:
+            to_check.pop(invoice_id, None)
+        return list(expired.values()), list(to_check.values())
+
+    async def wait_due(self, max_wait):
+        """
+        Ждет ближайшего срока, нового более раннего срока или max_wait секунд
+        """
+        timeout = max_wait
+        if self._deadlines:
+            timeout = max(0, min(max_wait, self._deadlines[0][0] - time.time()))
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,213 @@
+import asyncio
+import base64
+import logging
+import time
+from datetime import datetime, timedelta
+
+from database import DATE_FORMAT, db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 100
+DEFAULT_TIMEOUT = 10
+# Как часто перепроверять каждую позицию (секунды)
+DEFAULT_CHECK_INTERVAL = 3600
+# Сколько проверок подряд должно провалиться, чтобы снять прокси с продажи
+DEFAULT_FAILURES_TO_QUARANTINE = 2
+# Адрес, к которому открывается туннель через прокси
+DEFAULT_CHECK_TARGET = 'www.google.com:443'
+# Сколько позиций проверять и сохранять за один проход
+BATCH_SIZE = 500
+
+
+class ProxyCheckError(Exception):
+    """
+    Прокси не прошел проверку
+    """
+
+
+def parse_proxy(data):
+    """
+    Разбирает строку ip:port или ip:port:login:password.
+    Возвращает (host, port, login, password) или None
+    """
+    parts = data.strip().split(':')
+    if len(parts) not in (2, 4) or not parts[1].isdigit():
+        return None
+    host, port = parts[0], int(parts[1])
+    if not 1 <= port <= 65535:
+        return None
+    login, password = (parts[2], parts[3]) if len(parts) == 4 else (None, None)
+    return host, port, login, password
+
+
+async def _connect_tunnel(host, port, login, password, target):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        request = f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n"
+        if login is not None:
+            credentials = base64.b64encode(f"{login}:{password}".encode()).decode()
+            request += f"Proxy-Authorization: Basic {credentials}\r\n"
+        writer.write((request + "\r\n").encode())
+        await writer.drain()
+
+        status_line = await reader.readline()
+        parts = status_line.split()
+        if len(parts) < 2 or parts[1] != b'200':
+            raise ProxyCheckError(f"CONNECT: {status_line.decode(errors='replace').strip() or 'нет ответа'}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+async def probe_proxy(host, port, login=None, password=None,
+                      target=DEFAULT_CHECK_TARGET, timeout=DEFAULT_TIMEOUT):
+    """
+    Проверяет прокси: TCP-подключение и HTTP CONNECT к target с авторизацией.
+    Возвращает задержку в секундах или бросает ProxyCheckError
+    """
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(_connect_tunnel(host, port, login, password, target), timeout)
+    except asyncio.TimeoutError:
+        raise ProxyCheckError(f"таймаут {timeout} с")
+    except (ConnectionError, OSError) as e:
+        raise ProxyCheckError(f"подключение: {e}")
+    return time.monotonic() - started
+
+
+def _fetch_due(conn, after_id, checked_before, limit):
+    return conn.execute('''SELECT id, product_id, proxy_data, is_available, is_quarantined, check_failures
+                           FROM proxy_items
+                           WHERE id > ?
+                             AND (is_available = 1 OR is_quarantined = 1)
+                             AND (last_checked_at IS NULL OR last_checked_at < ?)
+                           ORDER BY id
+                           LIMIT ?''', (after_id, checked_before, limit)).fetchall()
+
+
+def _change_stock(conn, product_id, delta):
+    # Возвращает остаток в продаже: без единиц, зарезервированных под открытые счета
+    row = conn.execute('''UPDATE product_stock SET available = available + ?
+                          WHERE product_id = ? RETURNING MAX(available - reserved, 0)''',
+                       (delta, product_id)).fetchone()
+    return row[0] if row else 0
+
+
+def _record_results(conn, results, failures_to_quarantine):
+    """
+    Сохраняет результаты проверки пачки; карантин и возврат в продажу
+    меняют счетчик наличия в той же транзакции.
+    Возвращает (снято с продажи, возвращено в продажу, {product_id: новый остаток в продаже})
+    """
+    now = datetime.now().strftime(DATE_FORMAT)
+    quarantined = 0
+    restored = 0
+    stock = {}
+    for item, latency, error in results:
+        item_id, product_id, _, _, is_quarantined, failures = item
+
+        if error is None:
+            conn.execute('''UPDATE proxy_items
+                            SET latency_ms = ?, last_checked_at = ?, check_failures = 0, last_error = NULL
+                            WHERE id = ?''', (round(latency * 1000), now, item_id))
+            if is_quarantined and conn.execute('''UPDATE proxy_items SET is_available = 1, is_quarantined = 0
+                                                  WHERE id = ? AND is_quarantined = 1''', (item_id,)).rowcount:
+                stock[product_id] = _change_stock(conn, product_id, 1)
+                restored += 1
+            continue
+
+        failures += 1
+        conn.execute('''UPDATE proxy_items
+                        SET latency_ms = NULL, last_checked_at = ?, check_failures = ?, last_error = ?
+                        WHERE id = ?''', (now, failures, error, item_id))
+        # Условие is_available = 1 не даст снять позицию, которую уже выдали покупателю
+        if failures >= failures_to_quarantine and conn.execute('''UPDATE proxy_items SET is_available = 0, is_quarantined = 1
+                                                                  WHERE id = ? AND is_available = 1''',
+                                                               (item_id,)).rowcount:
+            stock[product_id] = _change_stock(conn, product_id, -1)
+            quarantined += 1
+
+    return quarantined, restored, stock
+
+
+class ProxyHealthChecker:
+    """
+    Фоновая проверка прокси из proxy_items.
+    Позиции в продаже и в карантине перепроверяются раз в interval секунд,
+    до concurrency проверок одновременно. Нерабочий прокси уходит в карантин
+    после failures_to_quarantine неудач подряд и возвращается в продажу,
+    когда снова проходит проверку.
+    После изменения остатков вызывается on_stock_change(product_id, остаток)
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, interval=DEFAULT_CHECK_INTERVAL,
+                 timeout=DEFAULT_TIMEOUT, target=DEFAULT_CHECK_TARGET,
+                 failures_to_quarantine=DEFAULT_FAILURES_TO_QUARANTINE, batch_size=BATCH_SIZE,
+                 on_stock_change=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.target = target
+        self.failures_to_quarantine = failures_to_quarantine
+        self.batch_size = batch_size
+        self.on_stock_change = on_stock_change
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _check(self, item):
+        parsed = parse_proxy(item[2] or '')
+        if parsed is None:
+            return item, None, "неверный формат"
+        async with self._semaphore:
+            try:
+                latency = await probe_proxy(*parsed, target=self.target, timeout=self.timeout)
+            except ProxyCheckError as e:
+                return item, None, str(e)
+            except Exception as e:
+                # Иначе одна позиция прервет gather() и весь проход на этой пачке
+                return item, None, f"ошибка проверки: {e!r}"
+        return item, latency, None
+
+    async def run_once(self):
+        """
+        Один проход по всем позициям, которым пора на проверку.
+        Возвращает сводку: checked, dead, quarantined, restored
+        """
+        checked_before = (datetime.now() - timedelta(seconds=self.interval)).strftime(DATE_FORMAT)
+        summary = {'checked': 0, 'dead': 0, 'quarantined': 0, 'restored': 0}
+        after_id = 0
+
+        while True:
+            items = await db.run(_fetch_due, after_id, checked_before, self.batch_size)
+            if not items:
+                break
+            after_id = items[-1][0]
+
+            results = await asyncio.gather(*(self._check(item) for item in items))
+            quarantined, restored, stock = await db.transaction(_record_results, results, self.failures_to_quarantine)
+            if self.on_stock_change:
+                for product_id, available in stock.items():
+                    self.on_stock_change(product_id, available)
+
+            summary['checked'] += len(results)
+            summary['dead'] += sum(1 for _, _, error in results if error is not None)
+            summary['quarantined'] += quarantined
+            summary['restored'] += restored
+
+        if summary['checked']:
+            logger.info(f"Проверка прокси: {summary}")
+        return summary
+
+    async def run(self):
+        """
+        Фоновая проверка, пока бот работает
+        """
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка проверки прокси: {e}")
+            # Позиции становятся due по одной, поэтому проверяем чаще интервала
+            await asyncio.sleep(min(self.interval, 300))
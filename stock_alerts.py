@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Изменения остатка за это время (секунды) объединяются в одно уведомление
+DEFAULT_DEBOUNCE = 30
+
+# Уровни остатка по возрастанию тревожности
+NORMAL = 0
+LOW = 1
+OUT = 2
+
+
+class StockAlerts:
+    """
+    Уведомления о заканчивающемся товаре по событиям изменения остатка.
+    Места, меняющие product_stock, сообщают новый остаток в продаже
+    (available - reserved, как видит покупатель) через observe()
+    после коммита, без дополнительных запросов к БД.
+    Изменения копятся debounce секунд, затем по каждому товару сравнивается
+    последний остаток с порогом: await threshold_for(product_id) -> порог или None.
+    Уведомление await notify(product_id, available, threshold) уходит, когда
+    остаток опускается до порога и когда заканчивается; повторно - только после
+    того, как остаток снова поднимется
+    """
+
+    def __init__(self, threshold_for, notify, debounce=DEFAULT_DEBOUNCE):
+        self.threshold_for = threshold_for
+        self.notify = notify
+        self.debounce = debounce
+        # product_id -> последний сообщенный остаток
+        self._pending = {}
+        # product_id -> уровень, о котором уже уведомили
+        self._alerted = {}
+        self._flush_task = None
+
+    def observe(self, product_id, available):
+        """
+        Новый остаток товара. Синхронный и ничего не ждет
+        """
+        self._pending[product_id] = available
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.debounce)
+        finally:
+            self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка уведомления об остатках: {e}")
+
+    async def flush(self):
+        """
+        Проверяет накопленные изменения остатков
+        """
+        pending, self._pending = self._pending, {}
+        for product_id, available in pending.items():
+            threshold = await self.threshold_for(product_id)
+            if threshold is None:
+                continue
+
+            if available <= 0:
+                level = OUT
+            elif available <= threshold:
+                level = LOW
+            else:
+                level = NORMAL
+
+            alerted = self._alerted.get(product_id, NORMAL)
+            if level == NORMAL:
+                self._alerted.pop(product_id, None)
+            else:
+                self._alerted[product_id] = level
+            # Уведомляем только когда ситуация ухудшилась
+            if level <= alerted:
+                continue
+
+            try:
+                await self.notify(product_id, available, threshold)
+            except Exception as e:
+                logger.error(f"Не удалось отправить уведомление об остатке товара {product_id}: {e}")